@@ -0,0 +1,189 @@
+"""用测试客户端压测api和网页程序的热点路径，输出每个操作的吞吐量、延迟和查询数(JSON)。
+
+    python -m benchmarks.hot_paths --users 10 --items 5000 --output before.json
+    python -m benchmarks.hot_paths --users 10 --items 5000 --compare before.json
+
+默认使用TestingConfig的内存数据库，--database 可以指定一个新的SQLite文件。
+--distribution skewed 时第一个用户的事项最多，其余用户按1/n递减；压测总是使用第一个用户。
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+from sqlalchemy import event
+
+from todoism import create_app
+from todoism.apis.v1.resources import encode_cursor
+from todoism.extensions import db
+from todoism.models import User, Item
+from todoism.settings import config
+
+PASSWORD = 'bench'
+
+
+def distribute(users, items, distribution):
+    """返回每个用户的事项数。"""
+    if distribution == 'uniform':
+        return [items // users] * users
+    weights = [1 / (n + 1) for n in range(users)]
+    return [max(1, int(items * weight / sum(weights))) for weight in weights]
+
+
+def seed(app, args):
+    with app.app_context():
+        db.create_all()
+        users = [User(username='bench%d' % n) for n in range(args.users)]
+        users[0].set_password(PASSWORD)
+        for user in users[1:]:
+            user.password_hash = users[0].password_hash  # 只哈希一次密码
+        db.session.add_all(users)
+        db.session.commit()
+        for user, count in zip(users, distribute(args.users, args.items, args.distribution)):
+            db.session.bulk_insert_mappings(Item, [
+                dict(body='事项 %d' % i, done=random.random() < args.done_ratio, author_id=user.id)
+                for i in range(count)])
+        db.session.commit()
+        return users[0].id
+
+
+def add_completed(app, user_id, count):
+    with app.app_context():
+        db.session.bulk_insert_mappings(Item, [dict(body='已完成', done=True, author_id=user_id)] * count)
+        db.session.commit()
+
+
+def measure(name, iterations, operation, queries, setup=None):
+    latencies = []
+    statements = 0
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        queries[0] = 0
+        start = time.perf_counter()
+        response = operation()
+        latencies.append(time.perf_counter() - start)
+        statements += queries[0]
+        if response.status_code >= 400:
+            raise SystemExit('%s 返回了 %d：%s' % (name, response.status_code, response.data[:200]))
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'ops_per_second': round(iterations / sum(latencies), 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 3),
+        'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 3),
+        'queries': round(statements / iterations, 2),
+    }
+
+
+def run(args):
+    config_name = 'testing'
+    if args.database:
+        if os.path.exists(args.database):
+            raise SystemExit('%s 已经存在，请指定一个新的文件。' % args.database)
+        config_name = args.config
+        config[config_name].SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.abspath(args.database)
+    app = create_app(config_name)
+    app.config['TODOISM_RATELIMIT'] = False  # 测量热点路径本身，单个用户的连续请求不应该被限流
+    app.config['WTF_CSRF_ENABLED'] = False
+    random.seed(args.seed)
+    user_id = seed(app, args)
+
+    queries = [0]
+    with app.app_context():
+        @event.listens_for(db.engine, 'after_cursor_execute')
+        def count_query(*_):
+            queries[0] += 1
+
+        total = Item.query.filter_by(author_id=user_id).count()
+        item_ids = [id for id, in db.session.query(Item.id).filter_by(author_id=user_id)]
+    per_page = app.config['TODOISM_ITEM_PER_PAGE']
+    last_page = max(1, (total + per_page - 1) // per_page)
+    deep_cursor = encode_cursor(item_ids[-per_page - 1] if len(item_ids) > per_page else 0)
+
+    api = app.test_client()
+    web = app.test_client()
+
+    def issue_token():
+        return api.post('/api/v1/oauth/token', data=dict(grant_type='password', username='bench0',
+                                                         password=PASSWORD))
+
+    tokens = issue_token().get_json()
+    headers = {'Authorization': 'Bearer ' + tokens['access_token']}
+    web.post('/login', json=dict(username='bench0', password=PASSWORD))
+    n = args.iterations
+
+    def get(path):
+        return lambda: api.get(path, headers=headers)
+
+    results = {
+        'token': measure('token', args.token_iterations, issue_token, queries),
+        'token_refresh': measure('token_refresh', n, lambda: api.post('/api/v1/oauth/token', data=dict(
+            grant_type='refresh_token', refresh_token=tokens['refresh_token'])), queries),
+        'user_schema': measure('user_schema', n, get('/api/v1/user'), queries),
+        'items_first_page': measure('items_first_page', n, get('/api/v1/user/items'), queries),
+        'items_deep_page': measure('items_deep_page', n, get('/api/v1/user/items?page=%d' % last_page), queries),
+        'items_deep_cursor': measure('items_deep_cursor', n, get('/api/v1/user/items?after=' + deep_cursor),
+                                     queries),
+        'active_items': measure('active_items', n, get('/api/v1/user/items/active'), queries),
+        'completed_items': measure('completed_items', n, get('/api/v1/user/items/completed'), queries),
+        'toggle': measure('toggle', n, lambda: api.patch('/api/v1/user/items/%d' % random.choice(item_ids),
+                                                        headers=headers), queries),
+        'app_render': measure('app_render', n, lambda: web.get('/app'), queries),
+        'clear_completed': measure('clear_completed', args.clear_iterations,
+                                   lambda: api.delete('/api/v1/user/items/completed', headers=headers), queries,
+                                   setup=lambda: add_completed(app, user_id, args.clear_size)),
+    }
+    return {
+        'meta': dict(vars(args), config=config_name, python=platform.python_version(),
+                     benchmark_user_items=total),
+        'operations': results,
+    }
+
+
+def compare(current, baseline):
+    """打印和基准结果的对比，吞吐量变化用百分比表示。"""
+    for name, result in current['operations'].items():
+        old = baseline['operations'].get(name)
+        if old is None:
+            continue
+        change = (result['ops_per_second'] / old['ops_per_second'] - 1) * 100
+        print('%-18s %9.1f ops/s %+7.1f%%  p99 %8.3f ms (was %8.3f)  queries %5.2f (was %5.2f)' % (
+            name, result['ops_per_second'], change, result['p99_ms'], old['p99_ms'],
+            result['queries'], old['queries']), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--items', type=int, default=5000, help='所有用户的事项总数')
+    parser.add_argument('--distribution', choices=['uniform', 'skewed'], default='skewed')
+    parser.add_argument('--done-ratio', type=float, default=0.5, help='已完成事项的比例')
+    parser.add_argument('--iterations', type=int, default=200, help='每个操作执行的次数')
+    parser.add_argument('--token-iterations', type=int, default=20, help='签发令牌要哈希密码，次数单独设置')
+    parser.add_argument('--clear-iterations', type=int, default=20)
+    parser.add_argument('--clear-size', type=int, default=100, help='每次清除前新增的已完成事项数')
+    parser.add_argument('--database', help='新建的SQLite文件路径，默认使用内存数据库')
+    parser.add_argument('--config', default='development', choices=['development', 'production'],
+                        help='使用--database时的配置')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='把结果写入这个JSON文件，默认输出到标准输出')
+    parser.add_argument('--compare', help='和之前保存的JSON结果对比')
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    else:
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
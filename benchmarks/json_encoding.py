@@ -0,0 +1,67 @@
+"""比较各个JSON编码器生成一页事项的耗时，以及不压缩、gzip和brotli时的响应大小。
+
+    python -m benchmarks.json_encoding --sizes 20 500 --rounds 200
+"""
+import argparse
+import json
+import timeit
+
+from flask import json as flask_json
+
+from todoism import create_app
+from todoism.apis.v1.encoding import ENCODERS, load_encoder, compress, brotli
+from todoism.apis.v1.schemas import items_schema
+from todoism.extensions import db
+from todoism.models import User, Item, UserIdentity
+
+
+def flask_dumps(obj):
+    """原来的jsonify：标准库json，非ASCII字符转义。"""
+    return (flask_json.dumps(obj, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[20, 500], help='每页的事项数')
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    app = create_app('testing')
+    encoders = [('flask.jsonify', flask_dumps)]
+    for name in ENCODERS:
+        loaded, dumps = load_encoder(name)
+        if loaded == name:
+            encoders.append((name, dumps))
+
+    with app.app_context():
+        db.create_all()
+        user = User(username='bench')
+        db.session.add(user)
+        db.session.commit()
+        db.session.bulk_insert_mappings(Item, [dict(body='明天晚上吃烤肉！第%d件事项' % i, done=i % 3 == 0,
+                                                    author_id=user.id) for i in range(max(args.sizes))])
+        db.session.commit()
+        identity = UserIdentity.from_user(user)
+
+        with app.test_request_context('/api/v1/user/items', base_url='https://todoism.example.com'):
+            for size in args.sizes:
+                items = Item.query.filter_by(author_id=user.id).limit(size).all()
+                url = 'https://todoism.example.com/api/v1/user/items?page=1'
+                data = items_schema(items, url, None, url, url, url, size, identity)
+                for name, dumps in encoders:
+                    body = dumps(data)
+                    seconds = timeit.timeit(lambda: dumps(data), number=args.rounds) / args.rounds
+                    result = {
+                        'items': size,
+                        'encoder': name,
+                        'encode_us': round(seconds * 1e6, 1),
+                        'bytes': len(body),
+                        'gzip_bytes': len(compress(body, 'gzip', app.config)),
+                    }
+                    if brotli is not None:
+                        result['br_bytes'] = len(compress(body, 'br', app.config))
+                    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""对正在运行的服务器做并发压测，比较同步和异步(todoism.asgi)两种运行方式。
+
+先分别启动两种服务器，例如：
+
+    gunicorn -w 1 --threads 8 -b :5000 'todoism:create_app()'
+    uvicorn --factory --port 5001 todoism.asgi:create_asgi_app
+
+然后对两者使用同样的参数压测：
+
+    python -m benchmarks.load_test http://127.0.0.1:5000 http://127.0.0.1:5001 \
+        --username NAME --password PASSWORD --concurrency 50 --slow-clients 20
+
+--slow-clients 会同时打开一些慢慢发送请求的连接，模拟网络很差的客户端。
+压测时所有请求来自同一个用户，启动服务器时设置TODOISM_RATELIMIT=0关闭限速，否则测到的是429。
+"""
+import argparse
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit, urlencode
+
+
+async def request(url, method='GET', headers=None, body=b'', slow=0):
+    """发送一个HTTP/1.1请求，返回(状态码, 响应体)。slow大于0时逐字节发送请求，每字节间隔slow秒。"""
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % parts.netloc, 'Connection: close',
+             'Content-Length: %d' % len(body)]
+    lines += ['%s: %s' % item for item in (headers or {}).items()]
+    data = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+    if slow:
+        for i in range(len(data)):
+            writer.write(data[i:i + 1])
+            await writer.drain()
+            await asyncio.sleep(slow)
+    else:
+        writer.write(data)
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b'\r\n\r\n')
+    return int(head.split(None, 2)[1]), payload
+
+
+async def get_token(base_url, username, password):
+    body = urlencode(dict(grant_type='password', username=username, password=password)).encode()
+    status, payload = await request(base_url + '/api/v1/oauth/token', 'POST', {
+        'Content-Type': 'application/x-www-form-urlencoded'}, body)
+    if status != 200:
+        raise SystemExit('获取令牌失败：%d %s' % (status, payload))
+    return json.loads(payload)['access_token']
+
+
+async def run(base_url, args):
+    token = await get_token(base_url, args.username, args.password)
+    headers = {'Authorization': 'Bearer ' + token}
+    latencies = []
+    errors = 0
+    deadline = time.time() + args.duration
+
+    async def client():
+        nonlocal errors
+        while time.time() < deadline:
+            start = time.time()
+            try:
+                status, _ = await request(base_url + args.path, headers=headers)
+            except OSError:
+                status = 0
+            latencies.append(time.time() - start)
+            if status != 200:
+                errors += 1
+
+    async def slow_client():
+        while time.time() < deadline:
+            try:
+                await request(base_url + args.path, headers=headers, slow=args.slow_delay)
+            except OSError:
+                pass
+
+    tasks = [client() for _ in range(args.concurrency)] + [slow_client() for _ in range(args.slow_clients)]
+    started = time.time()
+    await asyncio.wait([asyncio.ensure_future(task) for task in tasks])
+    elapsed = time.time() - started
+
+    latencies.sort()
+    return {
+        'url': base_url,
+        'requests': len(latencies),
+        'errors': errors,
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+        'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 2) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('urls', nargs='+', help='服务器地址，例如 http://127.0.0.1:5000')
+    parser.add_argument('--username', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--path', default='/api/v1/user/items', help='压测的路径')
+    parser.add_argument('--concurrency', type=int, default=50, help='正常客户端的数量')
+    parser.add_argument('--slow-clients', type=int, default=0, help='慢客户端的数量')
+    parser.add_argument('--slow-delay', type=float, default=0.05, help='慢客户端发送每个字节的间隔秒数')
+    parser.add_argument('--duration', type=float, default=10, help='每个服务器压测的秒数')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    for url in args.urls:
+        print(json.dumps(loop.run_until_complete(run(url.rstrip('/'), args))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""比较逐条url_for的旧序列化方式和批量序列化器生成一页事项的耗时。
+
+    python -m benchmarks.serialization --items 20 --rounds 2000
+"""
+import argparse
+import timeit
+
+from flask import url_for
+
+from todoism import create_app
+from todoism.apis.v1.schemas import items_schema
+from todoism.extensions import db
+from todoism.models import User, Item, UserIdentity
+
+
+def legacy_items_schema(items):
+    """原来的实现：每个事项调用三次url_for，并且读取item.author。"""
+    return [{
+        'id': item.id,
+        'self': url_for('api_v1.item', item_id=item.id, _external=True),
+        'kind': 'Item',
+        'body': item.body,
+        'done': item.done,
+        'author': {
+            'id': item.author_id,
+            'url': url_for('api_v1.user', _external=True),
+            'username': item.author.username,
+            'kind': 'User',
+        },
+    } for item in items]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--items', type=int, default=20, help='每页的事项数')
+    parser.add_argument('--rounds', type=int, default=2000)
+    args = parser.parse_args()
+
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        user = User(username='bench')
+        db.session.add(user)
+        db.session.add_all(Item(body='事项 %d' % i, author=user) for i in range(args.items))
+        db.session.commit()
+        items = Item.query.filter_by(author_id=user.id).all()
+        identity = UserIdentity.from_user(user)
+
+        with app.test_request_context('/api/v1/user/items'):
+            before = timeit.timeit(lambda: legacy_items_schema(items), number=args.rounds)
+            after = timeit.timeit(lambda: items_schema(items, None, None, None, None, None, None, identity),
+                                  number=args.rounds)
+
+    print('%d items per page, %d rounds' % (args.items, args.rounds))
+    print('per-item url_for: %.1f us/page' % (before / args.rounds * 1e6))
+    print('bulk serializer:  %.1f us/page' % (after / args.rounds * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""比较使用和不使用ProductionConfig的SQLite配置时，并发切换事项和读取事项列表的吞吐量。
+
+    python -m benchmarks.sqlite_contention --readers 8 --writers 4 --duration 5
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from todoism import create_app
+from todoism.extensions import db
+from todoism.models import User, Item
+from todoism.settings import DevelopmentConfig, ProductionConfig
+
+
+def seed(app, items):
+    with app.app_context():
+        db.create_all()
+        user = User(username='bench')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.commit()
+        db.session.bulk_insert_mappings(Item, [dict(body='事项 %d' % i, done=False, author_id=user.id)
+                                               for i in range(items)])
+        db.session.commit()
+
+
+def run(config_class, path, args):
+    # 每种配置使用单独的数据库文件，WAL模式会写进数据库文件里。
+    config_class.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+    app = create_app('production' if config_class is ProductionConfig else 'development')
+    seed(app, args.items)
+    token = app.test_client().post('/api/v1/oauth/token', data=dict(
+        grant_type='password', username='bench', password='bench')).get_json()['access_token']
+    headers = {'Authorization': 'Bearer ' + token}
+
+    counts = {'reads': 0, 'writes': 0, 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.time() + args.duration
+
+    def worker(write):
+        client = app.test_client()
+        while time.time() < deadline:
+            if write:
+                response = client.patch('/api/v1/user/items/%d' % random.randint(1, args.items), headers=headers)
+                ok = response.status_code == 204
+            else:
+                response = client.get('/api/v1/user/items?page=%d' % random.randint(1, args.items // 20),
+                                      headers=headers)
+                ok = response.status_code == 200
+            with lock:
+                counts['errors' if not ok else 'writes' if write else 'reads'] += 1
+
+    threads = [threading.Thread(target=worker, args=(True,)) for _ in range(args.writers)]
+    threads += [threading.Thread(target=worker, args=(False,)) for _ in range(args.readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with app.app_context():
+        db.engine.dispose()
+    return dict(profile=config_class.__name__,
+                reads_per_second=round(counts['reads'] / args.duration, 1),
+                writes_per_second=round(counts['writes'] / args.duration, 1),
+                errors=counts['errors'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--items', type=int, default=2000)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=5)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        for config_class in (DevelopmentConfig, ProductionConfig):
+            path = os.path.join(directory, config_class.__name__ + '.db')
+            print(json.dumps(run(config_class, path, args)))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
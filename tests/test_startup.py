@@ -0,0 +1,22 @@
+"""冷启动时间的回归测试：在新进程里导入todoism并调用create_app，耗时不能超过上限。
+
+上限可以用TODOISM_MAX_COLD_START环境变量调整，较慢的机器上运行时放宽。
+"""
+import os
+
+from todoism.startup import profile_startup
+
+MAX_COLD_START = float(os.getenv('TODOISM_MAX_COLD_START', 1.5))  # 秒
+
+
+def test_cold_start_within_bound():
+    result, modules = profile_startup('testing')
+    total = result['import'] + result['create_app']
+    assert total < MAX_COLD_START, '冷启动用了%.3f秒，超过了%.3f秒' % (total, MAX_COLD_START)
+
+
+def test_faker_not_imported_at_startup():
+    # faker只在第一次生成测试账号时导入，-X importtime的输出里不应该有它
+    result, modules = profile_startup('testing')
+    if modules:
+        assert 'faker' not in {name for name, self_seconds, cumulative in modules}
@@ -1,18 +1,34 @@
 import flask
 
+import gzip
 import os
+import time
+from functools import partial
 
 import click
-from flask import Flask, render_template, jsonify
+from flask import Flask, render_template, jsonify, request
+from flask_babel import get_locale
 from flask_login import current_user
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import event, func, inspect
+from sqlalchemy.schema import CreateColumn
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from todoism.apis.v1 import api_v1
 from todoism.blueprints.auth import auth_bp
 from todoism.blueprints.home import home_bp
 from todoism.blueprints.todo import todo_bp
-from todoism.extensions import db, login_manage, csrf, babel
+from todoism import assets, metrics
+from todoism.events import event_stream_available
+from todoism.extensions import db, login_manage, csrf, babel, set_sqlite_pragmas
 from todoism.models import User, Item
+from todoism.passwords import PasswordBusy
+from todoism.ratelimit import RateLimited, WritesBusy
+from todoism.search import rebuild_search_index
+from todoism.services import get_item_counts
 from todoism.settings import config
+from todoism.startup import profile_startup
+from todoism.transfer import generate_ndjson, all_items_query, parse_records, import_items
 
 
 def create_app(config_name=None):
@@ -21,22 +37,53 @@ def create_app(config_name=None):
 
     app = Flask('todoism')
     app.config.from_object(config[config_name])
+    if app.config['TODOISM_PROXY_FIX_X_FOR'] or app.config['TODOISM_PROXY_FIX_X_PROTO']:
+        # 只信任配置的代理层数，客户端自己伪造的X-Forwarded-For不会被当作客户端IP
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TODOISM_PROXY_FIX_X_FOR'],
+                                x_proto=app.config['TODOISM_PROXY_FIX_X_PROTO'])
 
-    register_extensions(app)
-    register_blueprints(app)
-    register_commands(app)
-    register_errors(app)
-    register_template_context(app)
+    phases = [
+        ('extensions', register_extensions),
+        ('blueprints', register_blueprints),
+        ('commands', register_commands),
+        ('errors', register_errors),
+        ('template_context', register_template_context),
+        ('assets', assets.init_app),
+    ]
+    if app.config['TODOISM_METRICS']:
+        phases.append(('metrics', metrics.init_app))
+    # 记录每个阶段的耗时，flask startup-profile用来找出拖慢冷启动的部分
+    timings = app.extensions['todoism_startup'] = []
+    for name, register in phases:
+        started = time.perf_counter()
+        register(app)
+        timings.append((name, time.perf_counter() - started))
     return app
 
 
 def register_extensions(app):
+    sqlite = app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite')
+    if sqlite and app.config.get('TODOISM_SQLITE_ENGINE_OPTIONS'):
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {},
+                                                       **app.config['TODOISM_SQLITE_ENGINE_OPTIONS'])
     db.init_app(app)
     login_manage.init_app(app)
     csrf.init_app(app)
     csrf.exempt(api_v1)  # csrf 设置了全局SCRF保护，但是api_v1不需要，因为api不进行cookie用户认证。
     babel.init_app(app)
 
+    pragmas = app.config.get('TODOISM_SQLITE_PRAGMAS')
+    if pragmas and sqlite:
+        with app.app_context():
+            event.listen(db.engine, 'connect', partial(set_sqlite_pragmas, pragmas=pragmas))
+
+    if app.config['TODOISM_JINJA_BYTECODE_CACHE']:
+        # 编译好的模版保存到文件里，重启后的工作进程不需要重新编译。目录为None时使用Jinja默认的临时目录。
+        directory = app.config['TODOISM_JINJA_CACHE_DIR']
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory, '__todoism_%s.cache')
+
 
 def register_blueprints(app):
     app.register_blueprint(auth_bp)
@@ -50,10 +97,10 @@ def register_template_context(app):  # 注册上下文
     @app.context_processor
     def make_template_context():
         if current_user.is_authenticated:  # 如果登陆
-            active_items = Item.query.with_parent(current_user).filter_by(done=False).count()
+            active_items = get_item_counts(current_user.id)['active']  # 和视图共用同一次计数查询
         else:
             active_items = None
-        return dict(active_items=active_items)
+        return dict(active_items=active_items, live_events=event_stream_available())
 
 '''
 @api_v1.route('/')
@@ -63,21 +110,43 @@ def index():
 
 
 def register_errors(app):
+    error_pages = {}
+
+    def render_error(code, info):
+        """错误页面只和区域、状态码有关，每种组合只渲染一次。不在TODOISM_LOCALES里的区域不缓存。"""
+        locale = str(get_locale())
+        if locale not in app.config['TODOISM_LOCALES']:
+            return render_template('errors.html', code=code, info=info), code
+        key = (locale, request.script_root, code)
+        if key not in error_pages:
+            error_pages[key] = render_template('errors.html', code=code, info=info)
+        return error_pages[key], code
+
     @app.errorhandler(400)
     def bad_request(e):
-        return render_template('errors.html', code=400, info='Bad Request'), 400
+        return render_error(400, 'Bad Request')
 
     @app.errorhandler(403)
     def forbidden(e):
-        return render_template('errors.html', code=403, info='forbidden'), 403
+        return render_error(403, 'forbidden')
 
     @app.errorhandler(404)
     def page_not_found(e):
-        return render_template('errors.html', code=404, info='page not found'), 404
+        return render_error(404, 'page not found')
 
     @app.errorhandler(500)
     def internal_server_error(e):
-        return render_template('errors.html', code=500, info='Server Errors'), 500
+        return render_error(500, 'Server Errors')
+
+    # 被限流的都是AJAX请求，返回JSON让页面显示提示。api蓝本有自己的处理函数。
+    @app.errorhandler(RateLimited)
+    def rate_limited(e):
+        return jsonify(message=e.args[0]), 429, {'Retry-After': str(e.retry_after)}
+
+    @app.errorhandler(WritesBusy)
+    @app.errorhandler(PasswordBusy)
+    def server_busy(e):
+        return jsonify(message=e.args[0]), 503, {'Retry-After': '1'}
 
 
 def register_commands(app):
@@ -90,3 +159,127 @@ def register_commands(app):
             click.echo('删除了数据库！')
         db.create_all()
         click.echo('初始化数据库！')
+
+    @app.cli.command()
+    def upgradedb():
+        """不删除数据，为已有的数据库补上新增的表、列和索引。"""
+        db.create_all()  # 只会创建不存在的表
+        inspector = inspect(db.engine)
+        for table in db.metadata.sorted_tables:
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    ddl = CreateColumn(column).compile(db.engine)
+                    db.engine.execute('ALTER TABLE %s ADD COLUMN %s' % (table.name, ddl))
+                    click.echo('添加了列 %s.%s。' % (table.name, column.name))
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(db.engine)
+                    click.echo('创建了索引 %s。' % index.name)
+        click.echo('升级了数据库！')
+
+    @app.cli.command()
+    def checkplans():
+        """检查热点查询的执行计划，如果有查询退化成全表扫描就失败。"""
+        failed = False
+        for name, query in hot_queries(user_id=1):
+            statement = query.statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+            plan = [row[-1] for row in db.session.execute('EXPLAIN QUERY PLAN ' + str(statement))]
+            # SCAN表示扫描整个表或索引，TEMP B-TREE表示查询结果需要额外排序。
+            bad = [step for step in plan if step.startswith('SCAN') or 'TEMP B-TREE' in step]
+            click.echo('%s %s: %s' % ('FAIL' if bad else 'ok', name, '; '.join(plan)))
+            failed = failed or bool(bad)
+        if failed:
+            raise click.ClickException('有热点查询没有使用索引。')
+
+    @app.cli.command('build-assets')
+    def build_assets():
+        """压缩静态文件，生成带哈希的文件名、manifest和预先压缩的版本。"""
+        for filename, hashed, size, built in assets.build_assets(app.static_folder):
+            click.echo('%s -> %s (%d -> %d bytes)' % (filename, hashed, size, built))
+        if assets.rjsmin is None:
+            click.echo('没有安装rjsmin，js文件没有压缩。', err=True)
+        if assets.brotli is None:
+            click.echo('没有安装brotli，只生成了gzip版本。', err=True)
+        click.echo('构建了静态文件！')
+
+    @app.cli.command('startup-profile')
+    @click.option('--config', 'config_name', default=lambda: os.getenv('FLASK_CONFIG', 'development'),
+                  help='测量的配置名称')
+    @click.option('--top', default=15, help='显示累计导入耗时最多的模块数')
+    @click.option('--max-seconds', type=float, help='导入和create_app超过这个秒数时失败，用来防止冷启动退化')
+    def startup_profile(config_name, top, max_seconds):
+        """在新进程里测量导入todoism、create_app各阶段和第一个请求的耗时。"""
+        try:
+            result, modules = profile_startup(config_name)
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        if modules:
+            click.echo('%10s %10s  %s' % ('self ms', 'cumul ms', 'module'))
+            for name, self_seconds, cumulative in sorted(modules, key=lambda m: m[2], reverse=True)[:top]:
+                click.echo('%10.1f %10.1f  %s' % (self_seconds * 1000, cumulative * 1000, name))
+            click.echo()
+        rows = [('import todoism', result['import']), ('create_app', result['create_app'])]
+        rows += [('  ' + name, seconds) for name, seconds in result['phases']]
+        rows += [('first request', result['first_request']), ('second request', result['second_request'])]
+        for name, seconds in rows:
+            click.echo('%-18s %8.1f ms' % (name, seconds * 1000))
+        total = result['import'] + result['create_app']
+        if max_seconds is not None and total > max_seconds:
+            raise click.ClickException('冷启动用了%.3f秒，超过了%.3f秒。' % (total, max_seconds))
+
+    @app.cli.command('rebuild-search')
+    def rebuild_search():
+        """创建或重建事项的全文索引，已有的数据库升级后运行一次。"""
+        if not rebuild_search_index():
+            raise click.ClickException('数据库不支持FTS5的trigram分词器，搜索会使用LIKE。')
+        click.echo('重建了搜索索引！')
+
+    @app.cli.command('export-items')
+    @click.argument('output', type=click.File('wb'))
+    @click.option('--gzip', 'compress', is_flag=True, help='用gzip压缩输出')
+    def export_items(output, compress):
+        """把所有用户的事项以NDJSON格式导出到文件，文件名为-时输出到标准输出。"""
+        if compress:
+            output = gzip.GzipFile(fileobj=output, mode='wb')
+        count = 0
+        for line in generate_ndjson(all_items_query()):
+            output.write(line.encode('utf-8'))
+            count += 1
+        output.close()
+        click.echo('导出了%d个事项！' % count, err=True)
+
+    @app.cli.command('import-items')
+    @click.argument('source', type=click.File('r', encoding='utf-8'))
+    @click.option('--username', required=True, help='事项导入到这个用户')
+    @click.option('--format', 'format', type=click.Choice(['ndjson', 'csv']), help='默认根据文件扩展名判断')
+    @click.option('--chunk-size', default=500, help='每个事务插入的行数')
+    def import_items_command(source, username, format, chunk_size):
+        """从NDJSON或CSV文件批量导入事项。"""
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.ClickException('用户%s不存在。' % username)
+        if format is None:
+            format = 'csv' if source.name.endswith('.csv') else 'ndjson'
+        imported, rejected = import_items(user.id, parse_records(source, format), chunk_size,
+                                          progress=lambda count: click.echo('已导入%d个事项……' % count))
+        for line, message in rejected:
+            click.echo('第%d行被拒绝：%s' % (line, message), err=True)
+        click.echo('导入了%d个事项，拒绝了%d行！' % (imported, len(rejected)))
+
+
+def hot_queries(user_id):
+    """资源、视图和序列化里频繁执行的查询，用来检查执行计划。"""
+    items = Item.query.filter_by(author_id=user_id)
+    return [
+        ('user by username', User.query.filter_by(username='')),
+        ('item counts', db.session.query(Item.done, func.count(Item.id)).filter(
+            Item.author_id == user_id).group_by(Item.done)),
+        ('items page', items.limit(20).offset(20)),
+        ('active items page', items.filter_by(done=False).limit(5).offset(5)),
+        ('completed items', items.filter_by(done=True)),
+        ('items after cursor', items.filter(Item.id > 0).order_by(Item.id).limit(21)),
+        ('items before cursor', items.filter(Item.id < 100).order_by(Item.id.desc()).limit(21)),
+        ('active items after cursor', items.filter_by(done=False).filter(Item.id > 0).order_by(Item.id).limit(21)),
+    ]
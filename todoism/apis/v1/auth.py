@@ -1,33 +1,159 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from functools import wraps
 
-from flask import g, current_app, request
+from flask import g, current_app, request, has_app_context
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer, BadSignature, SignatureExpired
+from sqlalchemy import event, inspect
 
 from todoism.apis.v1.errors import api_abort, invalid_token, token_missing
-from todoism.models import User
+from todoism.extensions import db
+from todoism.models import User, UserIdentity, RefreshToken
 
 
-def generate_token(user):
-    expiration = 3600
-    s = Serializer(current_app.config['SECRET_KEY'], expires_in=expiration)
-    token = s.dumps({'id': user.id}).decode('ascii')
+class TokenCache(object):
+    """从已验证的令牌到用户身份的有界LRU缓存。
+
+    条目在令牌过期或者超过ttl秒后失效，ttl也限制了其他进程里删除用户或修改密码后缓存还有效的时间。
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    del self._entries[token]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, token, identity, expires_at):
+        with self._lock:
+            self._entries[token] = (identity, min(expires_at, time.time() + self.ttl))
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for token in [token for token, entry in self._entries.items() if entry[0].id == user_id]:
+                del self._entries[token]
+
+    def info(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, size=len(self._entries), maxsize=self.maxsize)
+
+
+# 序列化器和令牌缓存每个程序实例只创建一次，保存在app.extensions里。
+def get_serializer():
+    serializer = current_app.extensions.get('todoism_token_serializer')
+    if serializer is None:
+        serializer = Serializer(current_app.config['SECRET_KEY'],
+                                expires_in=current_app.config['TODOISM_ACCESS_TOKEN_EXPIRATION'])
+        current_app.extensions['todoism_token_serializer'] = serializer
+    return serializer
+
+
+def get_refresh_serializer():
+    """刷新令牌使用不同的salt签名，不能当作访问令牌使用，反过来也一样。"""
+    serializer = current_app.extensions.get('todoism_refresh_serializer')
+    if serializer is None:
+        serializer = Serializer(current_app.config['SECRET_KEY'], salt='todoism-refresh-token',
+                                expires_in=current_app.config['TODOISM_REFRESH_TOKEN_EXPIRATION'])
+        current_app.extensions['todoism_refresh_serializer'] = serializer
+    return serializer
+
+
+def get_token_cache():
+    cache = current_app.extensions.get('todoism_token_cache')
+    if cache is None:
+        cache = TokenCache(current_app.config['TODOISM_TOKEN_CACHE_SIZE'],
+                           current_app.config['TODOISM_TOKEN_CACHE_TTL'])
+        current_app.extensions['todoism_token_cache'] = cache
+    return cache
+
+
+def generate_token(user_id):
+    token = get_serializer().dumps({'id': user_id}).decode('ascii')
+    return token, current_app.config['TODOISM_ACCESS_TOKEN_EXPIRATION']
+
+
+def generate_refresh_token(user_id):
+    """签发刷新令牌并记录它的jti，顺便删除这个用户已经过期的记录。"""
+    expiration = current_app.config['TODOISM_REFRESH_TOKEN_EXPIRATION']
+    now = datetime.utcnow()
+    RefreshToken.query.filter(RefreshToken.user_id == user_id, RefreshToken.expires_at <= now).delete(
+        synchronize_session=False)
+    jti = secrets.token_hex(16)
+    db.session.add(RefreshToken(id=jti, user_id=user_id, expires_at=now + timedelta(seconds=expiration)))
+    db.session.commit()
+    token = get_refresh_serializer().dumps({'id': user_id, 'jti': jti}).decode('ascii')
     return token, expiration
 
 
-# 用来验证令牌是否有效
-def validate_token(token):
-    s = Serializer(current_app.config['SECRET_KEY'])
+def load_refresh_token(token):
+    """验证刷新令牌的签名，再用jti查一次主键确认没有被撤销，不需要计算密码哈希。"""
     try:
-        data = s.loads(token)
+        data = get_refresh_serializer().loads(token)
     except (BadSignature, SignatureExpired):
-        return False
-    user = User.query.get(data['id'])  # 使用令牌中的id来查询对应的用户对象
-    if user is None:
-        return False
-    g.current_user = user   # 将用户储存到g上  g是Flask提供的全局对象
+        return None
+    record = RefreshToken.query.get(data.get('jti'))
+    if record is None or record.user_id != data.get('id'):
+        return None
+    return record
+
+
+def revoke_refresh_token(token):
+    record = load_refresh_token(token)
+    if record is not None:
+        db.session.delete(record)
+        db.session.commit()
+
+
+# 用来验证令牌是否有效
+def validate_token(token):
+    cache = get_token_cache()
+    identity = cache.get(token)
+    if identity is None:
+        try:
+            data, header = get_serializer().loads(token, return_header=True)
+        except (BadSignature, SignatureExpired):
+            return False
+        user = User.query.get(data['id'])  # 使用令牌中的id来查询对应的用户对象
+        if user is None:
+            return False
+        identity = UserIdentity.from_user(user)
+        cache.set(token, identity, header['exp'])
+    g.current_user = identity   # 将用户身份储存到g上  g是Flask提供的全局对象
     return True
 
 
+# 用户被删除或者修改了密码之后，它的令牌不能再从缓存里通过验证。
+@event.listens_for(User, 'after_delete')
+def _invalidate_deleted_user(mapper, connection, target):
+    if has_app_context():
+        get_token_cache().invalidate_user(target.id)
+
+
+@event.listens_for(User, 'after_update')
+def _invalidate_password_change(mapper, connection, target):
+    if has_app_context() and inspect(target).attrs.password_hash.history.has_changes():
+        get_token_cache().invalidate_user(target.id)
+
+
 # 由于flask的request只支持解析Basic和Digest类型的授权字段，所以我们需要自己解析Authorization首部字段来获取令牌值
 def get_token():
     if 'Authorization' in request.headers:
@@ -0,0 +1,97 @@
+"""api的JSON编码和响应压缩。
+
+TODOISM_JSON_ENCODER选择编码器：auto依次尝试orjson、ujson，都没有安装时使用标准库json。
+所有编码器都输出按键排序的紧凑UTF-8 JSON。
+客户端接受br或gzip并且响应超过TODOISM_COMPRESS_MIN_SIZE字节时压缩响应体，流式响应不压缩。
+"""
+import gzip
+import json
+
+from flask import current_app, request
+
+from todoism.apis.v1 import api_v1
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/csv', 'text/plain'}
+
+
+def stdlib_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def orjson_dumps():
+    import orjson
+    return lambda obj: orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+
+
+def ujson_dumps():
+    import ujson
+    return lambda obj: ujson.dumps(obj, ensure_ascii=False, sort_keys=True).encode('utf-8')
+
+
+ENCODERS = {
+    'orjson': orjson_dumps,
+    'ujson': ujson_dumps,
+    'json': lambda: stdlib_dumps,
+}
+
+
+def load_encoder(name):
+    """返回(编码器名称, dumps函数)，指定的编码器没有安装时退回到标准库。"""
+    for candidate in (['orjson', 'ujson'] if name == 'auto' else [name]):
+        try:
+            return candidate, ENCODERS[candidate]()
+        except ImportError:
+            pass
+    return 'json', stdlib_dumps
+
+
+def get_dumps():
+    dumps = current_app.extensions.get('todoism_json_dumps')
+    if dumps is None:
+        dumps = load_encoder(current_app.config['TODOISM_JSON_ENCODER'])[1]
+        current_app.extensions['todoism_json_dumps'] = dumps
+    return dumps
+
+
+def jsonify(*args, **kwargs):
+    """和flask.jsonify用法相同，使用配置的编码器。"""
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+    data = args[0] if len(args) == 1 else args or kwargs
+    return current_app.response_class(get_dumps()(data), mimetype='application/json')
+
+
+def compress(data, encoding, config):
+    if encoding == 'br':
+        return brotli.compress(data, quality=config['TODOISM_BROTLI_QUALITY'])
+    return gzip.compress(data, config['TODOISM_GZIP_LEVEL'])
+
+
+@api_v1.after_request
+def compress_response(response):
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or response.direct_passthrough or response.is_streamed:
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    config = current_app.config
+    if response.content_length is not None and response.content_length < config['TODOISM_COMPRESS_MIN_SIZE']:
+        return response
+    if brotli is not None and request.accept_encodings.quality('br') > 0:
+        encoding = 'br'
+    elif request.accept_encodings.quality('gzip') > 0:
+        encoding = 'gzip'
+    else:
+        return response
+    response.set_data(compress(response.get_data(), encoding, config))
+    response.headers['Content-Encoding'] = encoding
+    # 压缩后的内容和原来的字节不同，强ETag改成弱ETag，etag_cached用弱比较处理条件请求。
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
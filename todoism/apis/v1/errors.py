@@ -1,7 +1,9 @@
-from flask import jsonify
 from werkzeug.http import HTTP_STATUS_CODES
 
 from todoism.apis.v1 import api_v1
+from todoism.apis.v1.encoding import jsonify
+from todoism.passwords import PasswordBusy
+from todoism.ratelimit import RateLimited, WritesBusy
 
 
 def api_abort(code, message=None, **kwargs):
@@ -32,3 +34,23 @@ class ValidationError(ValueError):
 def validation_error(e):
     return api_abort(400, e.args[0])
 
+
+@api_v1.errorhandler(PasswordBusy)
+def password_busy(e):
+    response = api_abort(503, e.args[0])
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+@api_v1.errorhandler(RateLimited)
+def rate_limited(e):
+    response = api_abort(429, e.args[0])
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+@api_v1.errorhandler(WritesBusy)
+def writes_busy(e):
+    response = api_abort(503, e.args[0])
+    response.headers['Retry-After'] = '1'
+    return response
@@ -1,22 +1,139 @@
-from flask import jsonify, request, current_app, url_for, g
+import base64
+import csv
+import hashlib
+import io
+from functools import wraps
+
+from flask import request, current_app, url_for, g, Response, stream_with_context, make_response
 from flask.views import MethodView
 
 from todoism.apis.v1 import api_v1
-from todoism.apis.v1.auth import auth_required, generate_token
+from todoism.apis.v1.auth import auth_required, generate_token, generate_refresh_token, load_refresh_token, \
+    revoke_refresh_token
+from todoism.apis.v1.encoding import jsonify
 from todoism.apis.v1.errors import api_abort, ValidationError
 from todoism.apis.v1.schemas import user_schema, item_schema, items_schema
+from todoism.events import event_stream_response
 from todoism.extensions import db
 from todoism.models import User, Item
-
-
-def get_item_body():
-    data = request.get_json()
-    body = data.get('body')
-    if body is None or str(body).strip() == '':
+from todoism.ratelimit import rate_limit, limit_writes
+from todoism.search import search_items
+from todoism.services import validate_item_body, valid_item_id, get_items_version, clear_completed_items
+from todoism.transfer import generate_ndjson, gzip_chunks, user_items_query, parse_records, import_items
+
+
+def get_item_body(data=None):
+    if data is None:
+        data = request.get_json()
+    try:
+        return validate_item_body(data.get('body'))
+    except ValueError as e:
         # 如果数据不存在要返回400响应，但因为这个函数是由视图方法调用的，所以不能直接使用api_abort
         # 只能通过抛出异常的方法处理，在脚本中定义了错误类，使用Flask提供的errorhandler装饰器，加载api_abort函数
-        raise ValidationError('事项是空的或者是无效值。')
-    return body
+        raise ValidationError(e.args[0])
+
+
+def etag_cached(f):
+    """为GET视图添加ETag和条件请求支持。
+
+    ETag由用户、用户事项的版本号和请求的完整路径生成，事项没有变化时直接返回304，不执行查询和序列化。
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        version = get_items_version(g.current_user.id)
+        key = '%s:%s:%s' % (g.current_user.id, version, request.full_path)
+        etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        if request.if_none_match.contains_weak(etag):  # 压缩后的响应使用弱ETag
+            response = current_app.response_class(status=304)
+        else:
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        return response
+    return decorated
+
+
+# 游标对客户端是不透明的字符串，内部只是事项id的base64编码。
+def encode_cursor(item_id):
+    return base64.urlsafe_b64encode(str(item_id).encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    if cursor == '':
+        return None
+    try:
+        item_id = int(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('ascii'))
+    except (ValueError, TypeError):
+        raise ValidationError('无效的游标。')
+    if not 0 <= item_id < 2 ** 63:  # 超出SQLite整数范围的值绑定参数时会溢出
+        raise ValidationError('无效的游标。')
+    return item_id
+
+
+def get_items_page(query, endpoint, per_page):
+    """分页返回事项集合。
+
+    默认使用page参数的页码分页；请求中带有after或before参数时使用游标分页，按(author_id, id)定位，
+    不做OFFSET扫描，只有count=1时才统计总数。
+    """
+    if 'after' in request.args or 'before' in request.args:
+        return get_items_cursor_page(query, endpoint, per_page)
+    return get_items_offset_page(query, endpoint, per_page)
+
+
+def get_items_offset_page(query, endpoint, per_page, **values):
+    """按page参数的页码分页，values会加到每个分页链接里。"""
+    page = request.args.get('page', 1, type=int)
+    pagination = query.paginate(page, per_page)
+    current = url_for(endpoint, page=page, _external=True, **values)
+    prev = None
+    if pagination.has_prev:
+        prev = url_for(endpoint, page=page - 1, _external=True, **values)
+    next = None
+    if pagination.has_next:
+        next = url_for(endpoint, page=page + 1, _external=True, **values)
+    first = url_for(endpoint, page=1, _external=True, **values)
+    last = url_for(endpoint, page=pagination.pages, _external=True, **values)
+    return items_schema(pagination.items, current, prev, next, first, last, pagination.total,
+                        author=g.current_user)
+
+
+def get_items_cursor_page(query, endpoint, per_page):
+    limit = request.args.get('limit', per_page, type=int)
+    limit = max(1, min(limit, current_app.config['TODOISM_ITEM_MAX_LIMIT']))
+    count = query.order_by(None).count() if request.args.get('count', 0, type=int) else None
+
+    if 'before' in request.args:
+        before = decode_cursor(request.args['before'])
+        if before is not None:
+            query = query.filter(Item.id < before)
+        # 倒序多取一条来判断前面是否还有数据，再翻转成正序。
+        items = query.order_by(Item.id.desc()).limit(limit + 1).all()
+        has_prev = len(items) > limit
+        items = items[:limit][::-1]
+        has_next = before is not None
+        current = url_for(endpoint, before=request.args['before'], limit=limit, _external=True)
+    else:
+        after = decode_cursor(request.args['after'])
+        if after is not None:
+            query = query.filter(Item.id > after)
+        items = query.order_by(Item.id).limit(limit + 1).all()
+        has_next = len(items) > limit
+        items = items[:limit]
+        has_prev = after is not None
+        current = url_for(endpoint, after=request.args['after'], limit=limit, _external=True)
+
+    prev = None
+    if has_prev and items:
+        prev = url_for(endpoint, before=encode_cursor(items[0].id), limit=limit, _external=True)
+    next = None
+    if has_next and items:
+        next = url_for(endpoint, after=encode_cursor(items[-1].id), limit=limit, _external=True)
+    # after和before为空时分别表示从头开始和从末尾开始。
+    first = url_for(endpoint, after='', limit=limit, _external=True)
+    last = url_for(endpoint, before='', limit=limit, _external=True)
+    return items_schema(items, current, prev, next, first, last, count, author=g.current_user)
 
 
 class IndexAPI(MethodView):
@@ -27,75 +144,109 @@ class IndexAPI(MethodView):
             "api_base_url": "http://example.com/api/v1",
             "current_user_url": "http://example.com/api/v1/user",
             "authentication_url": "http://example.com/api/v1/token",
+            "revocation_url": "http://example.com/api/v1/oauth/revoke",
             "item_url": "http://example.com/api/v1/items/{item_id }",
-            "current_user_items_url": "http://example.com/api/v1/user/items{?page,per_page}",
-            "current_user_active_items_url": "http://example.com/api/v1/user/items/active{?page,per_page}",
-            "current_user_completed_items_url": "http://example.com/api/v1/user/items/completed{?page,per_page}",
+            "current_user_items_url": "http://example.com/api/v1/user/items{?page,after,before,limit,count}",
+            "current_user_active_items_url":
+                "http://example.com/api/v1/user/items/active{?page,after,before,limit,count}",
+            "current_user_completed_items_url":
+                "http://example.com/api/v1/user/items/completed{?page,after,before,limit,count}",
+            "current_user_items_search_url": "http://example.com/api/v1/user/items/search{?q,page}",
         })
 
 
 class AuthTokenAPI(MethodView):
 
+    @rate_limit('auth')
     def post(self):
-        """必须实现下面三个值，还有一个是scope，代表允许的权限范围，由api提供方自己定义。"""
-        grant_type = request.form.get('grant_type')
-        username = request.form.get('username')
-        password = request.form.get('password')
-
-        if grant_type is None or grant_type.lower() != 'password':
-            return api_abort(code=400, message='授权类型必须是密码。')
-
-        user = User.query.filter_by(username=username).first()
-        if user is None or not user.validate_password(password):
-            return api_abort(code=400, message='无效的账户密码')
-
-        token, expiration = generate_token(user)
-
-        response = jsonify({
+        """必须实现下面三个值，还有一个是scope，代表允许的权限范围，由api提供方自己定义。
+
+        grant_type为password时验证用户名和密码，同时签发刷新令牌；
+        为refresh_token时只验证刷新令牌的签名，不需要再计算密码哈希。
+        """
+        grant_type = (request.form.get('grant_type') or '').lower()
+        refresh_token = None
+
+        if grant_type == 'password':
+            username = request.form.get('username')
+            password = request.form.get('password')
+            user = User.query.filter_by(username=username).first()
+            if user is None or not user.validate_password(password):
+                return api_abort(code=400, message='无效的账户密码')
+            db.session.commit()  # 保存登录时升级的密码哈希
+            user_id = user.id
+            refresh_token, refresh_expiration = generate_refresh_token(user_id)
+        elif grant_type == 'refresh_token':
+            record = load_refresh_token(request.form.get('refresh_token', ''))
+            if record is None:
+                return api_abort(code=400, message='刷新令牌过期或无效。')
+            user_id = record.user_id
+        else:
+            return api_abort(code=400, message='授权类型必须是password或refresh_token。')
+
+        token, expiration = generate_token(user_id)
+
+        data = {
             'access_token': token,  # access_token 令牌
             'token_type': 'Bearer', # 认证类型
             'expires_in': expiration # 过期时间
-        })
+        }
+        if refresh_token is not None:
+            data['refresh_token'] = refresh_token
+            data['refresh_token_expires_in'] = refresh_expiration
+        response = jsonify(data)
         response.headers['Cache-Control'] = 'no-store'
         response.headers['Pragma'] = 'no-cache'
         return response
 
 
+class RevokeTokenAPI(MethodView):
+
+    def post(self):
+        """撤销刷新令牌。按照RFC 7009，令牌无效或已经撤销时也返回200。"""
+        revoke_refresh_token(request.form.get('token', ''))
+        return '', 200
+
+
 # 每个事项条目的所有api
 class ItemAPI(MethodView):
     # decorators 由MethodView提供， 使用这个值可以为整个资源类的所有视图方法附加装饰器
     decorators = [auth_required]
 
+    @etag_cached
     def get(self, item_id):
         '''获取条目'''
         item = Item.query.get_or_404(item_id)
-        if g.current_user != item.author:
+        if item.author_id != g.current_user.id:
             return api_abort(403)
-        return jsonify(item_schema(item))
+        return jsonify(item_schema(item, g.current_user))
 
+    @limit_writes
     def put(self, item_id):
         """编辑条目"""
         item = Item.query.get_or_404(item_id)
-        if g.current_user != item.author:
+        if item.author_id != g.current_user.id:
             return api_abort(403)
         item.body = get_item_body()
         db.session.commit()
         # 也可以返回创建修改资源后的新的资源，或者一个message，这里只返回了空白204。
         return '', 204
 
+    @limit_writes
     def patch(self, item_id):
         """修改条目完成状态"""
         item = Item.query.get_or_404(item_id)
-        if g.current_user != item.author:
+        if item.author_id != g.current_user.id:
             return api_abort(403)
         item.done = not item.done
         db.session.commit()
         return '', 204
 
+    @limit_writes
     def delete(self, item_id):
         """删除条目"""
         item =  Item.query.get_or_404(item_id)
-        if g.current_user != item.author:
+        if item.author_id != g.current_user.id:
             return api_abort(403)
         db.session.delete(item)
         db.session.commit()
@@ -105,6 +256,7 @@ class ItemAPI(MethodView):
 class UserAPI(MethodView):
     decorators = [auth_required]
 
+    @etag_cached
     def get(self):
         return jsonify(user_schema(g.current_user))
 
@@ -112,27 +264,19 @@ class UserAPI(MethodView):
 class ItemsAPI(MethodView):
     decorators = [auth_required]
 
+    @etag_cached
     def get(self):
         """获得当前用户的所有条目。"""
-        page = request.args.get('page', 1, type=int)
         per_page = current_app.config['TODOISM_ITEM_PER_PAGE']
-        pagination = Item.query.with_parent(g.current_user).paginate(page, per_page)
-        items = pagination.items
-        current = url_for('.items', page=page, _external=True)
-        prev = None
-        if pagination.has_prev:
-            prev = url_for('.items', page=page - 1, _external=True)
-        next = None
-        if pagination.has_next:
-            next = url_for('.items', page=page + 1, _external=True)
-        return jsonify(items_schema(items, current, prev, next, pagination))
+        return jsonify(get_items_page(Item.query.filter_by(author_id=g.current_user.id), '.items', per_page))
 
+    @limit_writes
     def post(self):
         """创建新条目."""
-        item = Item(body=get_item_body(), author=g.current_user)
+        item = Item(body=get_item_body(), author_id=g.current_user.id)
         db.session.add(item )
         db.session.commit()
-        response = jsonify(item_schema(item))
+        response = jsonify(item_schema(item, g.current_user))
         response.status_code = 201
         response.headers['Location'] = url_for('.item', item_id=item.id, _external=True)
         return response
@@ -141,52 +285,166 @@ class ItemsAPI(MethodView):
 class ActiveItemsAPI(MethodView):
     decorators = [auth_required]
 
+    @etag_cached
     def get(self):
         """获得用户所有未完成的事项"""
-        page = request.args.get('page', 1, type=int)
-        pagination = Item.query.with_parent(g.current_user).filter_by(done=False).paginate(
-            page, per_page=5)
-        items = pagination.items
-        current = url_for('.items', page=page, _external=True)
-        prev = None
-        if pagination.has_prev:
-            prev = url_for('.active_items', page=page - 1, _external=True)
-        next = None
-        if pagination.has_next:
-            next = url_for('.active_items', page=page + 1, _external=True)
-        return jsonify(items_schema(items, current, prev, next, pagination))
+        query = Item.query.filter_by(author_id=g.current_user.id, done=False)
+        return jsonify(get_items_page(query, '.active_items', per_page=5))
+
+
+class SearchItemsAPI(MethodView):
+    decorators = [auth_required]
+
+    @etag_cached
+    def get(self):
+        """搜索用户的事项，q是用空白分隔的搜索词，结果按相关度排序并用page参数分页。"""
+        q = request.args.get('q', '').strip()
+        if not q:
+            raise ValidationError('搜索词是空的。')
+        per_page = current_app.config['TODOISM_ITEM_PER_PAGE']
+        return jsonify(get_items_offset_page(search_items(g.current_user.id, q), '.search_items', per_page, q=q))
 
 
 class CompletedItemsAPI(MethodView):
     decorators = [auth_required]
 
+    @etag_cached
     def get(self):
         """获得用户所有完成的事项"""
-        page = request.args.get('page', 1, type=int)
-        pagination = Item.query.with_parent(g.current_user).filter_by(done=True).paginate(
-            page, per_page=5)
-        items = pagination.items
-        current = url_for('.items', page=page, _external=True)
-        prev = None
-        if pagination.has_prev:
-            prev = url_for('.completed_items', page=page - 1, _external=True)
-        next = None
-        if pagination.has_next:
-            next = url_for('.completed_items', page=page + 1, _external=True)
-        return jsonify(items_schema(items, current, prev, next, pagination))
+        query = Item.query.filter_by(author_id=g.current_user.id, done=True)
+        return jsonify(get_items_page(query, '.completed_items', per_page=5))
 
+    @limit_writes
     def delete(self):
         """删除所有该用户已经完成的事项"""
-        Item.query.with_parent(g.current_user).filter_by(done=True).delete()
-        db.session.commit()  # TODO: is it better use for loop?
+        clear_completed_items(g.current_user.id)
         return '', 204
 
 
+class ExportItemsAPI(MethodView):
+    decorators = [auth_required]
+
+    def get(self):
+        """以NDJSON格式流式导出当前用户的所有事项，客户端接受gzip时压缩输出。"""
+        chunks = generate_ndjson(user_items_query(g.current_user.id))
+        response = Response(mimetype='application/x-ndjson')
+        if request.accept_encodings.quality('gzip') > 0:
+            chunks = gzip_chunks(chunks)
+            response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Content-Disposition'] = 'attachment; filename=items.ndjson'
+        # stream_with_context让生成器在整个响应期间保留请求上下文和数据库会话。
+        response.response = stream_with_context(chunks)
+        return response
+
+
+class ItemEventsAPI(MethodView):
+    decorators = [auth_required]
+
+    def get(self):
+        """以服务器推送事件(text/event-stream)的形式推送当前用户事项的变化。"""
+        return event_stream_response(g.current_user.id)
+
+
+class ImportItemsAPI(MethodView):
+    decorators = [auth_required]
+
+    @limit_writes
+    def post(self):
+        """从NDJSON或CSV格式的请求体批量导入事项，返回导入数和被拒绝的行。
+
+        Content-Type为text/csv时按CSV解析(需要body列，可选done列)，否则按NDJSON解析。
+        """
+        stream = io.TextIOWrapper(request.stream, encoding='utf-8')
+        records = parse_records(stream, 'csv' if request.mimetype == 'text/csv' else 'ndjson')
+        # 解析错误之前的批次已经提交，返回的400说明从哪里开始没有导入
+        try:
+            imported, rejected = import_items(g.current_user.id, records,
+                                              current_app.config['TODOISM_IMPORT_CHUNK_SIZE'])
+        except UnicodeDecodeError:
+            raise ValidationError('请求体不是UTF-8编码的文本，出错位置之前的事项已经导入。')
+        except csv.Error as e:
+            raise ValidationError('CSV格式错误：%s，出错位置之前的事项已经导入。' % e)
+        max_rejected = current_app.config['TODOISM_IMPORT_MAX_REJECTED']
+        return jsonify(imported=imported, rejected_count=len(rejected), rejected=[
+            dict(line=line, message=message) for line, message in rejected[:max_rejected]])
+
+
+class BatchItemsAPI(MethodView):
+    decorators = [auth_required]
+
+    @limit_writes
+    def post(self):
+        """在一个事务里批量创建、编辑、切换和删除事项，返回每个操作的结果。
+
+        请求体是{"operations": [{"op": "create", "body": ...}, {"op": "update", "id": 1, "body": ...},
+        {"op": "toggle", "id": 2}, {"op": "delete", "id": 3}]}，无效的操作会被跳过并在结果里说明。
+        """
+        data = request.get_json()
+        operations = data.get('operations') if isinstance(data, dict) else None
+        if not isinstance(operations, list) or not operations:
+            raise ValidationError('operations必须是非空的列表。')
+        if len(operations) > current_app.config['TODOISM_BATCH_MAX_OPERATIONS']:
+            raise ValidationError('一次最多提交%d个操作。' % current_app.config['TODOISM_BATCH_MAX_OPERATIONS'])
+
+        # 用一次IN查询取出所有要操作的事项。
+        ids = {op.get('id') for op in operations if isinstance(op, dict) and valid_item_id(op.get('id'))}
+        items = {item.id: item for item in Item.query.filter(Item.id.in_(ids))} if ids else {}
+
+        results = []
+        for op in operations:
+            try:
+                results.append(self.apply(op, items))
+            except ValidationError as e:
+                results.append({'op': op.get('op') if isinstance(op, dict) else None,
+                                'status': 400, 'message': e.args[0]})
+        db.session.flush()  # 生成新建事项的id
+        for result in results:
+            if 'item' in result:
+                result['item'] = item_schema(result['item'], g.current_user)
+        db.session.commit()
+        return jsonify(results=results)
+
+    def apply(self, op, items):
+        if not isinstance(op, dict) or op.get('op') not in ('create', 'update', 'toggle', 'delete'):
+            raise ValidationError('操作类型必须是create、update、toggle或delete。')
+        if op['op'] == 'create':
+            item = Item(body=get_item_body(op), author_id=g.current_user.id)
+            db.session.add(item)
+            return {'op': 'create', 'status': 201, 'item': item}
+
+        if not valid_item_id(op.get('id')):
+            raise ValidationError('id必须是有效的整数。')
+        item = items.get(op['id'])
+        result = {'op': op['op'], 'id': op['id']}
+        if item is None:
+            result['status'] = 404
+            return result
+        if item.author_id != g.current_user.id:
+            result['status'] = 403
+            return result
+        if op['op'] == 'update':
+            item.body = get_item_body(op)
+        elif op['op'] == 'toggle':
+            item.done = not item.done
+        else:
+            db.session.delete(item)
+            del items[item.id]  # 同一批里后面再操作这个事项时返回404
+        result['status'] = 204
+        return result
+
+
 #     as_view方法将函数转化成视图函数        端点值，比如index，user，是自定义的。
 api_v1.add_url_rule('/', view_func=IndexAPI.as_view('index'), methods=['GET'])
 api_v1.add_url_rule('/oauth/token', view_func=AuthTokenAPI.as_view('token'), methods=['POST'])
+api_v1.add_url_rule('/oauth/revoke', view_func=RevokeTokenAPI.as_view('revoke_token'), methods=['POST'])
 api_v1.add_url_rule('/user', view_func=UserAPI.as_view('user'), methods=['GET'])
 api_v1.add_url_rule('/user/items', view_func=ItemsAPI.as_view('items'), methods=['GET', 'POST'])
+api_v1.add_url_rule('/user/items/search', view_func=SearchItemsAPI.as_view('search_items'), methods=['GET'])
+api_v1.add_url_rule('/user/items/export', view_func=ExportItemsAPI.as_view('export_items'), methods=['GET'])
+api_v1.add_url_rule('/user/items/events', view_func=ItemEventsAPI.as_view('item_events'), methods=['GET'])
+api_v1.add_url_rule('/user/items/import', view_func=ImportItemsAPI.as_view('import_items'), methods=['POST'])
+api_v1.add_url_rule('/user/items/batch', view_func=BatchItemsAPI.as_view('batch_items'), methods=['POST'])
 api_v1.add_url_rule('/user/items/<int:item_id>', view_func=ItemAPI.as_view('item'),
                     methods=['GET', 'PUT', 'PATCH', 'DELETE'])
 api_v1.add_url_rule('/user/items/active', view_func=ActiveItemsAPI.as_view('active_items'), methods=['GET'])
@@ -2,10 +2,11 @@
 
 from flask import url_for
 
-from todoism.models import Item
+from todoism.services import get_item_counts
 
 
 def user_schema(user):
+    counts = get_item_counts(user.id)
     return {
         'id': user.id,
         'self': url_for('.user', _external=True),  # _external 返回的是完整的路径
@@ -14,36 +15,57 @@ def user_schema(user):
         'all_items_url': url_for('.items', _external=True),
         'active_items_url': url_for('.active_items', _external=True),
         'completed_items_url': url_for('.completed_items', _external=True),
-        'all_item_count': len(user.items),
-        'active_item_count': Item.query.with_parent(user).filter_by(done=False).count(),
-        'completed_item_count': Item.query.with_parent(user).filter_by(done=True).count(),
+        'all_item_count': counts['all'],
+        'active_item_count': counts['active'],
+        'completed_item_count': counts['completed'],
         }
 
 
-def item_schema(item):
-    return {
-        'id': item.id,
-        'self': url_for('.item', item_id=item.id, _external=True),
-        'kind': 'Item',
-        'body': item.body,
-        'done': item.done,
-        'author': {
-            'id': 1,
-            'url': url_for('.user', _external=True),
-            'username': Item.author.username,
-            'kind': 'User',
-        },
-    }
+def item_schema(item, author=None):
+    """author是事项的作者，为None时使用item.author。"""
+    serialize = item_serializer()
+    return serialize(item, author or item.author)
+
+
+def item_serializer():
+    """返回序列化事项的函数。
+
+    url前缀只用url_for生成一次，每个事项的url用字符串拼接，代替逐条调用url_for。
+    """
+    # 单个事项的路由是 /user/items/<int:item_id>，即集合url后面加上id。
+    item_url = url_for('.items', _external=True) + '/%d'
+    user_url = url_for('.user', _external=True)
+
+    def serialize(item, author):
+        return {
+            'id': item.id,
+            'self': item_url % item.id,
+            'kind': 'Item',
+            'body': item.body,
+            'done': item.done,
+            'author': {
+                'id': item.author_id,
+                'url': user_url,
+                'username': author.username,
+                'kind': 'User',
+            },
+        }
+    return serialize
+
 
+def items_schema(items, current, prev, next, first, last, count, author=None):
+    """页码分页和游标分页共用，游标分页时prev/next是游标链接，count在没有请求时为None。
 
-def items_schema(items, current, prev, next, pagination):
+    集合里的事项都属于author时传入author，不需要再逐个加载item.author。
+    """
+    serialize = item_serializer()
     return {
         'self': current,
         'kind': 'ItemCollection',
-        'items': [item_schema(item) for item in items],
+        'items': [serialize(item, author or item.author) for item in items],
         'prev': prev,
-        'last': url_for('.items', page=pagination.pages, _external=True),
-        'first': url_for('.items', page=1, _external=True),
+        'last': last,
+        'first': first,
         'next': next,
-        'count': pagination.total
+        'count': count
     }
@@ -0,0 +1,221 @@
+"""异步(ASGI)运行方式。
+
+同步部署时，每个请求从读请求体到发送完响应都占用一个工作线程，慢客户端会占满所有线程。
+这里的适配器在事件循环里读请求体和发送响应，只在执行视图函数时占用线程池里的线程，
+一个进程可以同时保持大量慢连接。路由、auth_required的认证方式和返回的JSON都与同步方式完全相同。
+
+使用任意ASGI服务器运行，例如：
+
+    uvicorn --factory todoism.asgi:create_asgi_app
+"""
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from todoism import create_app
+from todoism.events import EVENT_STREAM_HEADER, get_broker, read_events
+
+
+class AsgiAdapter(object):
+    """把WSGI程序包装成ASGI程序，视图在有界的线程池里执行。"""
+
+    def __init__(self, wsgi_app, max_workers=8, queue_size=16):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.queue_size = queue_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise RuntimeError('不支持的ASGI类型：%s' % scope['type'])
+
+        body = await self.read_body(receive)
+        environ = self.build_environ(scope, body)
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue(self.queue_size)
+        worker = loop.run_in_executor(self.executor, self.run_wsgi, environ, queue, loop)
+        try:
+            handoff = await self.send_response(queue, send)
+            if handoff is not None:
+                await self.stream_events(handoff, receive, send)
+        finally:
+            # 客户端中途断开时继续取走队列里的数据，让工作线程能够结束。
+            while not worker.done():
+                getter = asyncio.ensure_future(queue.get())
+                await asyncio.wait([getter, worker], return_when=asyncio.FIRST_COMPLETED)
+                getter.cancel()
+        await worker
+
+    async def send_response(self, queue, send):
+        """把队列里的响应发给客户端。视图返回事件流时不发送，返回(响应头, 用户id, 最后的事件id)。"""
+        started = False
+        handoff = None
+        while True:
+            kind, value = await queue.get()
+            if kind == 'start':
+                status, headers = value
+                stream = [value for name, value in headers if name == EVENT_STREAM_HEADER]
+                if stream:
+                    user_id, last_id = stream[0].split(':')
+                    # 视图返回的是空响应，去掉它的Content-Length
+                    headers = [(name, value) for name, value in headers
+                               if name not in (EVENT_STREAM_HEADER, 'Content-Length')]
+                    handoff = (headers, int(user_id), int(last_id))
+                    continue
+                await send({
+                    'type': 'http.response.start',
+                    'status': int(status.split(None, 1)[0]),
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                for name, value in headers],
+                })
+                started = True
+            elif kind == 'body':
+                if handoff is None:
+                    await send({'type': 'http.response.body', 'body': value, 'more_body': True})
+            elif kind == 'error':
+                if not started:
+                    await send({'type': 'http.response.start', 'status': 500,
+                                'headers': [(b'content-type', b'text/plain')]})
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+                raise value
+            elif handoff is not None:
+                return handoff
+            else:
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+                return None
+
+    async def stream_events(self, handoff, receive, send):
+        """在事件循环里推送事件流，只在读取事件表时短暂使用线程池，空闲连接不占用线程。"""
+        headers, user_id, last_id = handoff
+        app = self.wsgi_app
+        loop = asyncio.get_event_loop()
+        notified = asyncio.Event()
+        disconnected = asyncio.ensure_future(self.wait_disconnect(receive))
+
+        def notify():
+            loop.call_soon_threadsafe(notified.set)
+
+        def read(last_id):
+            with app.app_context():
+                return read_events(user_id, last_id)
+
+        broker = get_broker(app)
+        broker.subscribe(user_id, notify)
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+            })
+            await send({'type': 'http.response.body', 'more_body': True,
+                        'body': ('retry: %d\n\n' % app.config['TODOISM_SSE_RETRY']).encode('utf-8')})
+            while not disconnected.done():
+                notified.clear()
+                chunk, last_id = await loop.run_in_executor(self.executor, read, last_id)
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+                    continue
+                waiter = asyncio.ensure_future(notified.wait())
+                done, _ = await asyncio.wait([waiter, disconnected], timeout=app.config['TODOISM_SSE_KEEPALIVE'],
+                                             return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                if not done:
+                    await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+        finally:
+            broker.unsubscribe(user_id, notify)
+            disconnected.cancel()
+
+    async def wait_disconnect(self, receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    def run_wsgi(self, environ, queue, loop):
+        """在工作线程里执行WSGI程序，把响应头和响应体块依次放进队列。
+
+        流式响应的生成器依赖线程本地的请求上下文，所以整个迭代过程都在同一个线程里完成。
+        队列满时线程会等待，事件循环把已有的数据发给客户端后再继续。
+        """
+        def put(kind, value=None):
+            asyncio.run_coroutine_threadsafe(queue.put((kind, value)), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            put('start', (status, headers))
+
+        iterable = None
+        try:
+            iterable = self.wsgi_app(environ, start_response)
+            for chunk in iterable:
+                if chunk:
+                    put('body', chunk)
+        except Exception as e:
+            put('error', e)
+            return
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+        put('end')
+
+    async def read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        return b''.join(chunks)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def build_environ(self, scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            # WSGI要求路径是用latin-1解码的原始字节
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'todoism.asgi': True,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+                continue
+            if name == 'CONTENT_LENGTH':
+                continue
+            key = 'HTTP_' + name
+            environ[key] = environ[key] + ',' + value if key in environ else value
+        return environ
+
+
+def create_asgi_app(config_name=None):
+    app = create_app(config_name)
+    return AsgiAdapter(app, max_workers=app.config['TODOISM_ASGI_WORKERS'])
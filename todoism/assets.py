@@ -0,0 +1,130 @@
+"""静态文件的构建和发送。
+
+flask build-assets 把static目录下的文件写到static/dist：压缩没有压缩过的css和js，文件名加上内容的哈希，
+为文本文件预先生成gzip和brotli(安装了brotli时)版本，并写出原文件名到新文件名的manifest.json。
+TODOISM_ASSET_MANIFEST开启并且manifest存在时，模版里的asset_url返回带哈希的/assets地址，
+这些地址的内容不会改变，可以让浏览器永久缓存，并按Accept-Encoding发送预先压缩好的文件。
+"""
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+from flask import request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+OUTPUT = 'dist'
+COMPRESSIBLE = {'.css', '.js', '.ico', '.svg', '.ttf', '.eot', '.json'}
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def minify_css(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    return re.sub(r'\s*([{};,])\s*', r'\1', text).replace(';}', '}').strip()
+
+
+def minify_js(text):
+    # JavaScript需要完整的词法分析才能安全地压缩，没有安装rjsmin时保持原样，只靠gzip/brotli压缩。
+    return rjsmin.jsmin(text) if rjsmin is not None else text
+
+
+def minify(filename, data):
+    if '.min.' in filename:
+        return data
+    if filename.endswith('.css'):
+        return minify_css(data.decode('utf-8')).encode('utf-8')
+    if filename.endswith('.js'):
+        return minify_js(data.decode('utf-8')).encode('utf-8')
+    return data
+
+
+def build_assets(static_folder):
+    """构建全部静态文件，返回[(原文件名, 新文件名, 原大小, 新大小)]。"""
+    output = os.path.join(static_folder, OUTPUT)
+    shutil.rmtree(output, ignore_errors=True)
+    manifest = {}
+    results = []
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder:
+            dirs[:] = [name for name in dirs if name != OUTPUT]
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, static_folder).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                source = f.read()
+            data = minify(filename, source)
+            base, ext = os.path.splitext(filename)
+            hashed = '%s.%s%s' % (base, hashlib.sha256(data).hexdigest()[:12], ext)
+            target = os.path.join(output, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+            if ext in COMPRESSIBLE:
+                variants = [('.gz', gzip_bytes(data))]
+                if brotli is not None:
+                    variants.append(('.br', brotli.compress(data)))
+                for suffix, compressed in variants:
+                    if len(compressed) < len(data):
+                        with open(target + suffix, 'wb') as f:
+                            f.write(compressed)
+            manifest[filename] = hashed
+            results.append((filename, hashed, len(source), len(data)))
+    with open(os.path.join(output, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return results
+
+
+def gzip_bytes(data):
+    # mtime固定为0，同样的内容每次构建得到同样的文件。Python 3.8以前的gzip.compress不能指定mtime。
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def init_app(app):
+    output = os.path.join(app.static_folder, OUTPUT)
+    manifest = {}
+    path = os.path.join(output, 'manifest.json')
+    if app.config['TODOISM_ASSET_MANIFEST'] and os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+
+    @app.template_global()
+    def asset_url(filename):
+        """和url_for('static', filename=...)用法相同，构建过的文件返回带哈希的地址。"""
+        if filename in manifest:
+            return url_for('assets', filename=manifest[filename])
+        return url_for('static', filename=filename)
+
+    def send_asset(filename):
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        encoding = None
+        for name, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if request.accept_encodings.quality(name) > 0 and os.path.exists(
+                    os.path.join(output, filename + suffix)):
+                encoding = name
+                filename += suffix
+                break
+        response = send_from_directory(output, filename, mimetype=mimetype, cache_timeout=IMMUTABLE_MAX_AGE)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+        response.vary.add('Accept-Encoding')
+        return response
+
+    app.add_url_rule('/assets/<path:filename>', 'assets', send_asset)
@@ -1,12 +1,28 @@
-from faker import Faker
 from flask import render_template, redirect, url_for, Blueprint,request,  jsonify
 from flask_login import login_user, logout_user, login_required, current_user
 
-from todoism.extensions import db
+from todoism.extensions import db, invalidate_session_user
 from todoism.models import User, Item
+from todoism.ratelimit import rate_limit, check_rate
 
 auth_bp = Blueprint('auth', __name__)
-fake = Faker()
+_fake = None
+
+
+def get_fake():
+    # faker导入和初始化需要上百毫秒，第一次生成测试账号时才加载，不拖慢每个工作进程的启动
+    global _fake
+    if _fake is None:
+        from faker import Faker
+        _fake = Faker()
+    return _fake
+
+
+@auth_bp.record
+def register_demo(state):
+    # 生产环境默认关闭TODOISM_DEMO_REGISTER，不注册/register，也就不会加载faker
+    if state.app.config['TODOISM_DEMO_REGISTER']:
+        state.add_url_rule('/register', 'register', rate_limit('auth')(register))
 
 
 @auth_bp.route('/login', methods=['GET', 'POST'])
@@ -15,12 +31,14 @@ def login():
         return redirect(url_for('todo.app'))    # 如果已经登陆
 
     if request.method == 'POST':
+        check_rate('auth')  # 只限制提交，不限制打开登录页面
         data = request.get_json()  # 获得的数据转换成json
         username = data['username']
         password = data['password']
 
         user = User.query.filter_by(username=username).first()
         if user is not None and user.validate_password(password):
+            db.session.commit()  # 保存登录时升级的密码哈希
             login_user(user)
             return jsonify(massage='登陆成功！')
         return jsonify(message = '无效的账号和密码！')
@@ -31,12 +49,13 @@ def login():
 @login_required
 def logout():
     logout_user()
+    invalidate_session_user()
     return jsonify(message="退出登录！")
 
 
-@auth_bp.route('/register')
 def register():   # 注册页面
     # 生成一个一个随机账户作为测试用户
+    fake = get_fake()
     username = fake.user_name()
     # 确定生成的虚拟用户不在数据库表中
     while User.query.filter_by(username=username).first() is not None:
@@ -1,7 +1,9 @@
 from flask import render_template, Blueprint, current_app, make_response, jsonify
 from flask_babel import _
 from flask_login import current_user
-from todoism.models import db
+
+from todoism.extensions import invalidate_session_user
+from todoism.models import db, User
 
 
 home_bp = Blueprint('home', __name__)
@@ -24,8 +26,9 @@ def set_locale(locale):
         return jsonify(message=_('无效的本地设置。')), 404
     response = make_response(jsonify(message=_('本地设置更新。')))
     if current_user.is_authenticated:  # 如果登陆了的话
-        current_user.locale = locale
+        User.query.filter_by(id=current_user.id).update({'locale': locale})
         db.session.commit()
+        invalidate_session_user()  # 下一个请求重新读取用户
     else:
         response.set_cookie('locale', locale, max_age=60 * 60 * 24 * 30)
     return response
@@ -1,41 +1,104 @@
-from flask import render_template, request, Blueprint, jsonify
+from flask import render_template, request, Blueprint, jsonify, current_app, url_for
 from flask_login import current_user, login_required
 
+from todoism.events import event_stream_response
 from todoism.extensions import db
 from todoism.models import Item
+from todoism.ratelimit import limit_writes
+from todoism.search import search_items as search_user_items
+from todoism.services import get_item_counts, clear_completed_items, valid_item_id, SQLITE_MAX_INTEGER
 
 todo_bp = Blueprint('todo', __name__)
 
 
+def render_fragment(name, **context):
+    """用编译好的模版直接渲染ajax返回的片段。
+
+    片段只用到传入的变量和url_for，不需要运行上下文处理函数，后者会为导航栏多查询一次事项计数。
+    """
+    return current_app.jinja_env.get_template(name).render(**context)
+
+
+def get_items_window(tab, after=None):
+    """返回某个标签页(all/active/completed)里id大于after的一窗口事项，以及加载下一窗口的url。"""
+    query = Item.query.filter_by(author_id=current_user.id)
+    if tab == 'active':
+        query = query.filter_by(done=False)
+    elif tab == 'completed':
+        query = query.filter_by(done=True)
+    if after is not None:
+        query = query.filter(Item.id > after)
+    window = current_app.config['TODOISM_APP_WINDOW']
+    items = query.order_by(Item.id).limit(window + 1).all()  # 多取一条判断后面是否还有事项
+    next_url = None
+    if len(items) > window:
+        next_url = url_for('.items', tab=tab, after=items[window - 1].id)
+    return items[:window], next_url
+
+
 @todo_bp.route('/app')
 @login_required
 def app():
-    all_count = Item.query.with_parent(current_user).count()  # 返回用户待办事项的个数
-    active_count = Item.query.with_parent(current_user).filter_by(done=False).count() # 未完成事项的个数
-    completed_count = Item.query.with_parent(current_user).filter_by(done=True).count() # 完成的事项的个数
-    return render_template('_app.html', items=current_user.items,
-                           all_count=all_count, active_count=active_count, completed_count=completed_count)
+    counts = get_item_counts(current_user.id)  # 所有、未完成和已完成事项的个数，一次查询得到
+    # 只渲染第一窗口的事项，剩下的由页面滚动时通过items视图加载。
+    items, next_url = get_items_window('all')
+    return render_template('_app.html', items=items, next_url=next_url, all_count=counts['all'],
+                           active_count=counts['active'], completed_count=counts['completed'])
+
+
+# 推送事项变化的事件流，其他页面或客户端修改了事项时页面会刷新
+@todo_bp.route('/items/events')
+@login_required
+def item_events():
+    return event_stream_response(current_user.id)
+
+
+# 按标签页分批加载事项，返回渲染好的事项html
+@todo_bp.route('/items/<any(all, active, completed):tab>')
+@login_required
+def items(tab):
+    after = request.args.get('after', type=int)
+    if after is not None and not valid_item_id(after):
+        return jsonify(message='无效的参数。'), 400
+    items, next_url = get_items_window(tab, after)
+    return jsonify(html=render_fragment('_items.html', items=items), next=next_url)
+
+
+# 搜索事项，按相关度分批返回渲染好的事项html
+@todo_bp.route('/items/search')
+@login_required
+def search_items():
+    q = request.args.get('q', '').strip()
+    offset = max(0, request.args.get('offset', 0, type=int))
+    window = current_app.config['TODOISM_APP_WINDOW']
+    if offset > SQLITE_MAX_INTEGER - window:  # 下一窗口的offset也不能超出SQLite整数范围
+        return jsonify(message='无效的参数。'), 400
+    items = search_user_items(current_user.id, q).offset(offset).limit(window + 1).all() if q else []
+    next_url = url_for('.search_items', q=q, offset=offset + window) if len(items) > window else None
+    return jsonify(html=render_fragment('_items.html', items=items[:window]), next=next_url)
 
 
 # 写新的事项
 @todo_bp.route('/item/mew', methods=['POST'])
 @login_required
+@limit_writes
 def new_item():
     data = request.get_json()   # 获取输入
     if data is None or data['body'].strip() == '':  # 如果data的body内容去除首尾的空格后返回的结果是空的
         return jsonify(message='无效的内容.'), 400
-    item = Item(body=data['body'], author=current_user._get_current_object())
+    item = Item(body=data['body'], author_id=current_user.id)
     db.session.add(item)
     db.session.commit()
-    return jsonify(html=render_template('_item.html', item=item), message='+1')
+    return jsonify(html=render_fragment('_item.html', item=item), message='+1')
 
 
 # 编辑事项
 @todo_bp.route('/item/<int:item_id>/edit', methods=['PUT'])
 @login_required
+@limit_writes
 def edit_item(item_id):
     item = Item.query.get_or_404(item_id)
-    if current_user != item.author:
+    if item.author_id != current_user.id:
         return jsonify(message='没有修改权限！'), 403
     data = request.get_json()
     if data is None or data['body'].strip() == '':  # 如果data的body内容去除首尾的空格后返回的结果是空的
@@ -49,9 +112,10 @@ def edit_item(item_id):
 # 更改完成状态
 @todo_bp.route('/item/<int:item_id>/toggle', methods=['PATCH'])  #PATCH方法请求一个更改的集合
 @login_required
+@limit_writes
 def toggle_item(item_id):
     item = Item.query.get_or_404(item_id)
-    if current_user != item.author:
+    if item.author_id != current_user.id:
         return jsonify(message="没有修改权限！"), 403
 
     item.done = not item.done
@@ -62,9 +126,10 @@ def toggle_item(item_id):
 # 删除事项
 @todo_bp.route('/item/<int:item_id>/delete', methods=['DELETE'])
 @login_required
+@limit_writes
 def delete_item(item_id):
     item = Item.query.get_or_404(item_id)
-    if current_user != item.author:
+    if item.author_id != current_user.id:
         return jsonify(message='没有权限'), 403
 
     db.session.delete(item)
@@ -74,11 +139,9 @@ def delete_item(item_id):
 
 @todo_bp.route('/item/clear', methods=['DELETE'])
 @login_required
+@limit_writes
 def clear_items():
-    items = Item.query.with_parent(current_user).filter_by(done=True).all()
-    for item in items:
-        db.session.delete(item)
-    db.session.commit()
+    clear_completed_items(current_user.id)
     return jsonify(message='删除了全部的事项！')
 
 
@@ -0,0 +1,183 @@
+"""这个模块记录事项变化的事件，并通过服务器推送事件(SSE)通知客户端。
+
+事件在写入事项的同一个事务里保存到ItemEvent表，事务提交后通过发布/订阅后端通知订阅了这个用户的连接，
+连接再从事件表读取新事件，所以客户端断线后可以用Last-Event-ID从事件表续传。
+"""
+import json
+import threading
+import time
+from collections import defaultdict
+
+from flask import current_app, request, has_app_context, has_request_context, Response, stream_with_context
+from sqlalchemy import event, inspect
+from werkzeug.utils import import_string
+
+from todoism.extensions import db
+from todoism.models import Item, ItemEvent
+
+# 异步运行方式(todoism.asgi)接管事件流时使用的响应头，值是"用户id:最后的事件id"
+EVENT_STREAM_HEADER = 'X-Todoism-Event-Stream'
+
+
+class InProcessBroker(object):
+    """进程内的发布/订阅后端。
+
+    只能通知同一个进程里的订阅者，其他进程的订阅者在下一次保活时从事件表读到新事件。
+    可以用TODOISM_EVENT_BROKER换成跨进程的实现，只需要提供相同的三个方法。
+    """
+
+    def __init__(self, app=None):
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id, callback):
+        with self._lock:
+            self._subscribers[user_id].add(callback)
+
+    def unsubscribe(self, user_id, callback):
+        with self._lock:
+            self._subscribers[user_id].discard(callback)
+            if not self._subscribers[user_id]:
+                del self._subscribers[user_id]
+
+    def publish(self, user_id):
+        with self._lock:
+            callbacks = list(self._subscribers.get(user_id, ()))
+        for callback in callbacks:
+            callback()
+
+
+def get_broker(app=None):
+    app = app or current_app._get_current_object()
+    broker = app.extensions.get('todoism_event_broker')
+    if broker is None:
+        broker = import_string(app.config['TODOISM_EVENT_BROKER'])(app)
+        app.extensions['todoism_event_broker'] = broker
+    return broker
+
+
+def record_event(user_id, kind, data, session=None, trim=True):
+    """在当前事务里记录一个事件，事务提交后通知订阅者。批量插入和删除不经过flush，需要手动调用。
+
+    trim为True时同时清理这个用户超出TODOISM_EVENT_LOG_SIZE的旧事件，flush监听器记录完所有事件后统一清理。
+    """
+    session = session or db.session
+    if has_request_context():
+        # 客户端可以用X-Client-Id标识自己，忽略自己引起的事件。
+        data = dict(data, origin=request.headers.get('X-Client-Id'))
+    events = ItemEvent.__table__
+    session.execute(events.insert().values(user_id=user_id, kind=kind, data=json.dumps(data, ensure_ascii=False)))
+    session.info.setdefault('todoism_event_users', set()).add(user_id)
+    if trim:
+        trim_events([user_id], session)
+
+
+def trim_events(user_ids, session):
+    """每个用户只保留最近的TODOISM_EVENT_LOG_SIZE条事件。"""
+    events = ItemEvent.__table__
+    for user_id in user_ids:
+        newest = db.select([events.c.id]).where(events.c.user_id == user_id).order_by(
+            events.c.id.desc()).limit(1).offset(current_app.config['TODOISM_EVENT_LOG_SIZE'])
+        session.execute(events.delete().where(events.c.user_id == user_id).where(
+            events.c.id <= newest.as_scalar()))
+
+
+def item_data(item):
+    return {'id': item.id, 'body': item.body, 'done': item.done}
+
+
+@event.listens_for(db.session, 'after_flush')
+def _record_item_events(session, flush_context):
+    if not has_app_context():
+        return
+    for obj in session.new | session.dirty | session.deleted:
+        if not isinstance(obj, Item):
+            continue
+        if obj in session.new:
+            record_event(obj.author_id, 'create', item_data(obj), session, trim=False)
+        elif obj in session.deleted:
+            record_event(obj.author_id, 'delete', {'id': obj.id}, session, trim=False)
+        elif session.is_modified(obj):
+            kind = 'toggle' if inspect(obj).attrs.done.history.has_changes() else 'update'
+            record_event(obj.author_id, kind, item_data(obj), session, trim=False)
+    trim_events(session.info.get('todoism_event_users', ()), session)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _publish_events(session):
+    user_ids = session.info.pop('todoism_event_users', None)
+    if user_ids and has_app_context():
+        broker = get_broker()
+        for user_id in user_ids:
+            broker.publish(user_id)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_events(session):
+    session.info.pop('todoism_event_users', None)
+
+
+def latest_event_id(user_id):
+    return db.session.query(db.func.max(ItemEvent.id)).filter(ItemEvent.user_id == user_id).scalar() or 0
+
+
+def read_events(user_id, last_id, limit=100):
+    """读取last_id之后的事件，返回(SSE格式的文本, 最后的事件id)。
+
+    如果last_id之后的事件已经被清理掉，发送一个reset事件，客户端需要重新获取事项。
+    """
+    events = ItemEvent.query.filter(ItemEvent.user_id == user_id, ItemEvent.id > last_id).order_by(
+        ItemEvent.id).limit(limit).all()
+    chunks = []
+    if events and last_id and ItemEvent.query.filter(
+            ItemEvent.user_id == user_id, ItemEvent.id <= last_id).first() is None:
+        chunks.append('event: reset\ndata: {}\n\n')
+    for item_event in events:
+        chunks.append('id: %d\nevent: %s\ndata: %s\n\n' % (item_event.id, item_event.kind, item_event.data))
+        last_id = item_event.id
+    db.session.remove()  # 等待期间不占用数据库连接
+    return ''.join(chunks), last_id
+
+
+def generate_events(app, user_id, last_id):
+    """同步运行方式下的事件流，连接保持TODOISM_SSE_STREAM_TIMEOUT秒后结束，客户端会自动重连续传。"""
+    notified = threading.Event()
+    broker = get_broker(app)
+    broker.subscribe(user_id, notified.set)
+    try:
+        yield 'retry: %d\n\n' % app.config['TODOISM_SSE_RETRY']
+        deadline = time.time() + app.config['TODOISM_SSE_STREAM_TIMEOUT']
+        while time.time() < deadline:
+            notified.clear()
+            chunk, last_id = read_events(user_id, last_id)
+            if chunk:
+                yield chunk
+            elif not notified.wait(app.config['TODOISM_SSE_KEEPALIVE']):
+                yield ': keepalive\n\n'
+    finally:
+        broker.unsubscribe(user_id, notified.set)
+
+
+def event_stream_available():
+    """异步运行时，或者开启了TODOISM_SSE_SYNC时才提供事件流。"""
+    return bool(request.environ.get('todoism.asgi') or current_app.config['TODOISM_SSE_SYNC'])
+
+
+def event_stream_response(user_id):
+    """返回用户事项变化的事件流，支持用Last-Event-ID首部或last_event_id参数续传。"""
+    if not event_stream_available():
+        # 按SSE规范，204让EventSource停止重连，不会每隔一段时间占用一个线程
+        return Response(status=204)
+    last_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'), type=int)
+    if last_id is None:
+        last_id = latest_event_id(user_id)  # 没有续传时只推送之后的事件
+    response = Response(mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # 让nginx不缓冲事件流
+    if request.environ.get('todoism.asgi'):
+        # 异步运行时由事件循环推送事件，空闲连接不占用线程。
+        response.headers[EVENT_STREAM_HEADER] = '%d:%d' % (user_id, last_id)
+        return response
+    app = current_app._get_current_object()
+    response.response = stream_with_context(generate_events(app, user_id, last_id))
+    return response
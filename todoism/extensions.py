@@ -1,7 +1,12 @@
-from flask import request, current_app
+import time
+from functools import lru_cache
+
+from flask import request, current_app, session
 from flask_babel import Babel, lazy_gettext as _l
 from flask_login import LoginManager, current_user
 from flask_sqlalchemy import SQLAlchemy
+from werkzeug.datastructures import LanguageAccept
+from werkzeug.http import parse_accept_header
 from flask_wtf.csrf import CSRFProtect
 
 db = SQLAlchemy()
@@ -13,10 +18,41 @@ login_manage.login_view = 'auth.login'
 login_manage.login_message = _l('请通过这个页面登陆！')
 
 
+def set_sqlite_pragmas(dbapi_connection, connection_record, pragmas):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
+
+
+SESSION_USER_KEY = 'todoism_user'
+
+
+# 用户快照保存在签名的会话里，有效期内直接使用快照，不查询数据库。
+# 有效期限制了其他地方删除用户或修改用户信息后快照还能使用的时间。
 @login_manage.user_loader
 def load_user(user_id):
-    from todoism.models import User
-    return User.query.get(int(user_id))
+    from todoism.models import User, SessionUser
+    snapshot = session.get(SESSION_USER_KEY)
+    if snapshot is not None and snapshot['id'] == int(user_id) and snapshot['expires'] > time.time():
+        return SessionUser(snapshot['id'], snapshot['username'], snapshot['locale'])
+    user = User.query.get(int(user_id))
+    if user is None:
+        return None
+    user = SessionUser.from_user(user)
+    expires = time.time() + current_app.config['TODOISM_SESSION_USER_TTL']
+    session[SESSION_USER_KEY] = dict(user.to_dict(), expires=expires)
+    return user
+
+
+def invalidate_session_user():
+    """用户信息改变或者退出登录后丢弃会话里的快照。"""
+    session.pop(SESSION_USER_KEY, None)
+
+
+@lru_cache(maxsize=256)
+def match_locale(accept_language, locales):
+    return parse_accept_header(accept_language, LanguageAccept).best_match(locales)
 
 
 # 设置区域选择函数
@@ -30,7 +66,8 @@ def get_locale():
         return locale
     # 如果最后也没有获得locale， 从客户端里面的语言偏好来获得。 需要传入TODOISM_LOCALES列表，
     # 与客户端语言偏好逐个匹配，返回最先匹配的结果。
-    return request.accept_languages.best_match(current_app.config['TODOISM_LOCALES'])
+    # 相同的Accept-Language首部只解析一次。
+    return match_locale(request.headers.get('Accept-Language', ''), tuple(current_app.config['TODOISM_LOCALES']))
 
 
 
@@ -0,0 +1,203 @@
+"""可选的性能统计，TODOISM_METRICS开启时才注册。
+
+统计每个端点的响应时间分布、每个请求的SQL查询数，以及SQL、模版渲染和密码哈希各占用的时间，
+记录慢查询样本，查询数超过TODOISM_METRICS_QUERY_THRESHOLD的请求记为疑似N+1并写日志。
+所有数据在/debug/metrics以Prometheus文本格式导出。关闭时不注册任何钩子，没有额外开销。
+"""
+import hmac
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict, deque, Counter
+from contextlib import contextmanager
+
+from flask import g, request, has_app_context, abort, Response
+from sqlalchemy import event
+
+from todoism.extensions import db
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestState(object):
+    """一个请求的统计数据，保存在g._metrics里。"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.statements = Counter()
+        self.seconds = defaultdict(float)
+
+
+class Metrics(object):
+    def __init__(self, app):
+        self.config = app.config
+        self.logger = app.logger
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)                 # (端点, 状态码) -> 请求数
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.queries = defaultdict(lambda: Histogram(QUERY_BUCKETS))
+        self.seconds = defaultdict(float)                # (端点, 类别) -> 秒数
+        self.flagged = defaultdict(int)                  # 端点 -> 疑似N+1的请求数
+        self.slow_queries = deque(maxlen=app.config['TODOISM_METRICS_SLOW_QUERY_SAMPLES'])
+
+    def record_request(self, endpoint, status, state):
+        elapsed = time.perf_counter() - state.started
+        with self._lock:
+            self.requests[endpoint, status] += 1
+            self.latency[endpoint].observe(elapsed)
+            self.queries[endpoint].observe(state.queries)
+            for kind, seconds in state.seconds.items():
+                self.seconds[endpoint, kind] += seconds
+        if state.queries > self.config['TODOISM_METRICS_QUERY_THRESHOLD']:
+            statement, repeated = state.statements.most_common(1)[0]
+            with self._lock:
+                self.flagged[endpoint] += 1
+            self.logger.warning('疑似N+1：%s %s 执行了%d条查询，重复最多的一条执行了%d次：%s',
+                                request.method, request.path, state.queries, repeated, ' '.join(statement.split()))
+
+    def record_query(self, statement, elapsed):
+        state = g.get('_metrics') if has_app_context() else None
+        if state is not None:
+            state.queries += 1
+            state.statements[statement] += 1
+            state.seconds['sql'] += elapsed
+        if elapsed >= self.config['TODOISM_METRICS_SLOW_QUERY']:
+            endpoint = request.endpoint if state is not None else None
+            self.slow_queries.append((endpoint or 'none', ' '.join(statement.split())[:200], elapsed))
+
+    def render(self, extra=()):
+        """以Prometheus文本格式输出所有数据。"""
+        lines = []
+
+        def metric(name, kind, help):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        def histogram(name, histograms):
+            for endpoint, histogram in sorted(histograms.items()):
+                total = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    total += count
+                    lines.append('%s_bucket{endpoint="%s",le="%s"} %d' % (name, escape(endpoint), bound, total))
+                lines.append('%s_bucket{endpoint="%s",le="+Inf"} %d' % (name, escape(endpoint), histogram.count))
+                lines.append('%s_sum{endpoint="%s"} %s' % (name, escape(endpoint), histogram.sum))
+                lines.append('%s_count{endpoint="%s"} %d' % (name, escape(endpoint), histogram.count))
+
+        with self._lock:
+            metric('todoism_requests_total', 'counter', 'Requests by endpoint and status.')
+            for (endpoint, status), count in sorted(self.requests.items()):
+                lines.append('todoism_requests_total{endpoint="%s",status="%d"} %d' % (escape(endpoint), status, count))
+            metric('todoism_request_duration_seconds', 'histogram', 'Request latency by endpoint.')
+            histogram('todoism_request_duration_seconds', self.latency)
+            metric('todoism_request_queries', 'histogram', 'SQL statements per request by endpoint.')
+            histogram('todoism_request_queries', self.queries)
+            metric('todoism_request_seconds_total', 'counter', 'Time spent in SQL, templates and password hashing.')
+            for (endpoint, kind), seconds in sorted(self.seconds.items()):
+                lines.append('todoism_request_seconds_total{endpoint="%s",kind="%s"} %s' % (
+                    escape(endpoint), kind, seconds))
+            metric('todoism_query_threshold_exceeded_total', 'counter',
+                   'Requests that issued more queries than TODOISM_METRICS_QUERY_THRESHOLD.')
+            for endpoint, count in sorted(self.flagged.items()):
+                lines.append('todoism_query_threshold_exceeded_total{endpoint="%s"} %d' % (escape(endpoint), count))
+            metric('todoism_slow_query_seconds', 'gauge', 'Most recent slow query samples.')
+            for endpoint, statement, elapsed in self.slow_queries:
+                lines.append('todoism_slow_query_seconds{endpoint="%s",statement="%s"} %s' % (
+                    escape(endpoint), escape(statement), elapsed))
+        for name, kind, help, value in extra:
+            metric(name, kind, help)
+            lines.append('%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+@contextmanager
+def timed(kind):
+    """统计代码块在当前请求里占用的时间，没有开启统计时什么也不做。"""
+    state = g.get('_metrics') if has_app_context() else None
+    if state is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        state.seconds[kind] += time.perf_counter() - started
+
+
+def init_app(app):
+    metrics = Metrics(app)
+    app.extensions['todoism_metrics'] = metrics
+
+    @app.before_request
+    def start_request():
+        g._metrics = RequestState()
+
+    @app.teardown_request
+    def finish_request(exc):
+        state = g.pop('_metrics', None)
+        if state is not None and request.endpoint != 'debug_metrics':
+            status = 500 if exc is not None else g.pop('_metrics_status', 500)
+            metrics.record_request(request.endpoint or 'none', status, state)
+
+    @app.after_request
+    def save_status(response):
+        g._metrics_status = response.status_code
+        return response
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('todoism_query_started', []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        metrics.record_query(statement, time.perf_counter() - conn.info['todoism_query_started'].pop())
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute', after_cursor_execute)
+
+    # 顶层模版的render经过这里，include的模版在同一次渲染里完成，不会重复计时。
+    template_class = app.jinja_env.template_class
+
+    class TimedTemplate(template_class):
+        def render(self, *args, **kwargs):
+            with timed('template'):
+                return template_class.render(self, *args, **kwargs)
+
+    app.jinja_env.template_class = TimedTemplate
+
+    def metrics_view():
+        token = app.config['TODOISM_METRICS_TOKEN']
+        if token and not hmac.compare_digest(request.args.get('token', ''), token):
+            abort(404)
+        extra = []
+        cache = app.extensions.get('todoism_token_cache')
+        if cache is not None:
+            info = cache.info()
+            extra += [
+                ('todoism_token_cache_hits_total', 'counter', 'Token validations served from the cache.', info['hits']),
+                ('todoism_token_cache_misses_total', 'counter', 'Token validations that decoded the token.',
+                 info['misses']),
+                ('todoism_token_cache_size', 'gauge', 'Tokens in the validation cache.', info['size']),
+            ]
+        return Response(metrics.render(extra), mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/debug/metrics', 'debug_metrics', metrics_view)
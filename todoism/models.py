@@ -1,7 +1,12 @@
+from datetime import datetime
+
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event
 
 from todoism.extensions import db
+from todoism.metrics import timed
+from todoism.passwords import hash_password, verify_password, needs_rehash
+from todoism.segment import segment, segment_default
 
 
 class User(db.Model, UserMixin):
@@ -9,21 +14,80 @@ class User(db.Model, UserMixin):
     username = db.Column(db.String(40), unique=True, index=True)
     password_hash = db.Column(db.String(128))
     locale = db.Column(db.String(20))
+    # 用户的事项每次被新建、修改或删除时加一，用作api响应的ETag
+    items_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     items = db.relationship('Item', back_populates='author', cascade='all')   # cascade是设置级联操作
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        with timed('password'):
+            self.password_hash = hash_password(password)
 
     def validate_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """验证密码，哈希方法过时的话顺便换成新的哈希，调用者需要提交会话。"""
+        with timed('password'):
+            if not verify_password(self.password_hash, password):
+                return False
+            if needs_rehash(self.password_hash):
+                self.password_hash = hash_password(password)
+            return True
+
+
+class UserIdentity(object):
+    """用户的轻量身份，只保存视图需要的字段，可以在不查询数据库的情况下代替User使用。"""
+
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username)
+
+
+class SessionUser(UserMixin, UserIdentity):
+    """保存在签名会话里的用户快照，网页视图用它代替User，不需要每个请求都查询一次用户。"""
+
+    def __init__(self, id, username, locale=None):
+        super(SessionUser, self).__init__(id, username)
+        self.locale = locale
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, user.locale)
+
+    def to_dict(self):
+        return dict(id=self.id, username=self.username, locale=self.locale)
 
 
 class Item(db.Model):
+    # 按用户和完成状态筛选事项的查询使用复合索引，按用户分页的查询使用author_id索引(SQLite索引中隐含了id)。
+    __table_args__ = (db.Index('ix_item_author_id_done', 'author_id', 'done'),)
+
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
+    # 切分了中日韩文字的内容，只用来建立搜索索引，查询事项时不加载
+    search_body = db.deferred(db.Column(db.Text, default=segment_default))
     done = db.Column(db.Boolean, default=False)
-    author_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     author = db.relationship('User', back_populates='items')
 
 
+@event.listens_for(Item.body, 'set')
+def _segment_body(target, value, oldvalue, initiator):
+    target.search_body = segment(value)
+
+
+class ItemEvent(db.Model):
+    """用户事项变化的事件日志，id同时是推送给客户端的事件id，每个用户只保留最近的若干条。"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    kind = db.Column(db.String(20))  # create、update、toggle、delete、clear或import
+    data = db.Column(db.Text)  # JSON格式的事件内容
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
 
+class RefreshToken(db.Model):
+    """已签发的刷新令牌，删除这一行就撤销了对应的令牌。"""
+    id = db.Column(db.String(32), primary_key=True)  # 令牌里的jti
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
@@ -0,0 +1,66 @@
+"""密码哈希。
+
+哈希方法和计算量由TODOISM_PASSWORD_METHOD设置，用户用旧方法的哈希登录成功时自动换成新方法。
+哈希计算在有界的线程池里执行，同时等待的请求超过TODOISM_PASSWORD_MAX_PENDING，
+或者等待超过TODOISM_PASSWORD_TIMEOUT秒时抛出PasswordBusy。登录高峰最多占用TODOISM_PASSWORD_WORKERS个CPU，
+等待哈希的请求线程也少于服务器的线程数，不会拖慢其他请求。
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+
+class PasswordBusy(RuntimeError):
+    """等待哈希计算的请求太多。"""
+
+
+class PasswordPool(object):
+    def __init__(self, workers, max_pending, timeout=None):
+        self.executor = ThreadPoolExecutor(workers)
+        self.timeout = timeout
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def run(self, func, *args):
+        if not self._pending.acquire(blocking=False):
+            raise PasswordBusy('登录请求太多，请稍后再试。')
+        try:
+            future = self.executor.submit(func, *args)
+            try:
+                return future.result(self.timeout)
+            except TimeoutError:
+                future.cancel()  # 还在排队的计算不再执行
+                raise PasswordBusy('登录请求太多，请稍后再试。')
+        finally:
+            self._pending.release()
+
+
+def get_password_pool():
+    pool = current_app.extensions.get('todoism_password_pool')
+    if pool is None:
+        pool = PasswordPool(current_app.config['TODOISM_PASSWORD_WORKERS'],
+                            current_app.config['TODOISM_PASSWORD_MAX_PENDING'],
+                            current_app.config['TODOISM_PASSWORD_TIMEOUT'])
+        current_app.extensions['todoism_password_pool'] = pool
+    return pool
+
+
+def password_method():
+    """返回配置的哈希方法，pbkdf2没有写迭代次数时补上werkzeug的默认值，和哈希里保存的方法一致。"""
+    method = current_app.config['TODOISM_PASSWORD_METHOD']
+    if method.startswith('pbkdf2:') and method.count(':') == 1:
+        method += ':%d' % DEFAULT_PBKDF2_ITERATIONS
+    return method
+
+
+def hash_password(password):
+    return get_password_pool().run(generate_password_hash, password, password_method())
+
+
+def verify_password(password_hash, password):
+    return get_password_pool().run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    return password_hash.split('$', 1)[0] != password_method()
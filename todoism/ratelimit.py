@@ -0,0 +1,124 @@
+"""写接口和认证接口的准入控制。
+
+rate_limit按令牌桶给每个用户(api令牌或登录会话)或者没有登录的客户端IP限速，
+TODOISM_RATE_LIMITS为每类接口设置(每秒补充的令牌数, 桶容量)，超过时抛出RateLimited，返回429和Retry-After。
+limit_writes在按'write'限速之外，还限制同时执行的写请求数：SQLite同一时间只有一个写者，
+排队的写请求只会等到busy_timeout超时，所以超过TODOISM_MAX_CONCURRENT_WRITES时直接抛出WritesBusy返回503。
+TODOISM_RATELIMIT只开关限速，并发上限由TODOISM_MAX_CONCURRENT_WRITES单独控制，设为0时关闭。
+两个装饰器都放在auth_required或login_required下面，这样能用认证后的用户作为限速的键。
+没有登录时按request.remote_addr限速。在反向代理后面运行时，它是代理的地址，
+必须把TODOISM_PROXY_FIX_X_FOR设置为代理的层数，由ProxyFix从X-Forwarded-For得到真实的客户端IP，
+否则所有匿名的登录和签发令牌请求共用同一个'auth'令牌桶。
+
+令牌桶默认保存在进程内，多个工作进程各自计数。可以用TODOISM_RATELIMIT_BACKEND换成共享的实现，
+只需要提供take(key, rate, burst)方法：消耗一个令牌时返回0，否则返回需要等待的秒数。
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, g, request
+from flask_login import current_user
+from werkzeug.utils import import_string
+
+
+class RateLimited(RuntimeError):
+    """请求太频繁。"""
+
+    def __init__(self, message, retry_after):
+        super(RateLimited, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class WritesBusy(RuntimeError):
+    """同时执行的写请求太多。"""
+
+
+class InProcessBackend(object):
+    """进程内的令牌桶，最多保存TODOISM_RATELIMIT_MAX_KEYS个键，超过时丢弃最久没有使用的桶。
+
+    被丢弃的桶下次使用时是满的，只会让限速变宽松。
+    """
+
+    def __init__(self, app=None):
+        self.maxsize = app.config['TODOISM_RATELIMIT_MAX_KEYS'] if app is not None else 10000
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+def get_backend():
+    backend = current_app.extensions.get('todoism_ratelimit_backend')
+    if backend is None:
+        backend = import_string(current_app.config['TODOISM_RATELIMIT_BACKEND'])(current_app._get_current_object())
+        current_app.extensions['todoism_ratelimit_backend'] = backend
+    return backend
+
+
+def get_write_slots():
+    slots = current_app.extensions.get('todoism_write_slots')
+    if slots is None:
+        slots = threading.BoundedSemaphore(current_app.config['TODOISM_MAX_CONCURRENT_WRITES'])
+        current_app.extensions['todoism_write_slots'] = slots
+    return slots
+
+
+def client_key():
+    """api令牌认证的用户、会话登录的用户，都没有时使用客户端IP。"""
+    user = g.get('current_user')
+    if user is None and current_user.is_authenticated:
+        user = current_user
+    return 'user:%d' % user.id if user is not None else 'ip:%s' % request.remote_addr
+
+
+def check_rate(scope):
+    if not current_app.config['TODOISM_RATELIMIT']:
+        return
+    rate, burst = current_app.config['TODOISM_RATE_LIMITS'][scope]
+    wait = get_backend().take('%s:%s' % (scope, client_key()), rate, burst)
+    if wait > 0:
+        raise RateLimited('请求太频繁，请稍后再试。', int(math.ceil(wait)))
+
+
+def rate_limit(scope):
+    """按TODOISM_RATE_LIMITS[scope]限速的装饰器。"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            check_rate(scope)
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+def limit_writes(f):
+    """写接口的装饰器：按'write'限速，并限制同时执行的写请求数。"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        check_rate('write')
+        if not current_app.config['TODOISM_MAX_CONCURRENT_WRITES']:
+            return f(*args, **kwargs)
+        slots = get_write_slots()
+        if not slots.acquire(blocking=False):
+            raise WritesBusy('服务器繁忙，请稍后再试。')
+        try:
+            return f(*args, **kwargs)
+        finally:
+            slots.release()
+    return decorated
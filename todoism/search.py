@@ -0,0 +1,118 @@
+"""事项内容的全文搜索。
+
+SQLite支持FTS5的trigram分词器(3.34以上)时，item_fts虚拟表以item表为外部内容建立索引，
+由触发器在插入、修改内容和删除事项时同步，所以网页视图、api和批量导入的写入都不需要额外处理。
+trigram按三个字符切分，中文不需要分词也能匹配任意子串，结果按bm25相关度排序。
+中文的搜索词大多只有一两个字，无法使用trigram索引，这些查询使用item_cjk：它用unicode61分词器索引
+search_body列(见todoism.segment，中日韩文字切成二元组)，同样由这些触发器同步，也按相关度排序。
+不支持FTS5的数据库，或者还没有运行rebuild-search的旧数据库，退回到只扫描当前用户事项的LIKE。
+"""
+from flask import current_app
+from sqlalchemy import event
+
+from todoism.extensions import db
+from todoism.models import Item
+from todoism.segment import segment
+
+INSERT_INDEX = ("INSERT INTO item_fts(rowid, body) VALUES (new.id, new.body); "
+                "INSERT INTO item_cjk(rowid, search_body) VALUES (new.id, new.search_body); ")
+DELETE_INDEX = ("INSERT INTO item_fts(item_fts, rowid, body) VALUES ('delete', old.id, old.body); "
+                "INSERT INTO item_cjk(item_cjk, rowid, search_body) VALUES ('delete', old.id, old.search_body); ")
+SEARCH_INDEX_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS item_fts USING fts5("
+    "body, content='item', content_rowid='id', tokenize='trigram')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS item_cjk USING fts5("
+    "search_body, content='item', content_rowid='id', tokenize='unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS item_fts_insert AFTER INSERT ON item BEGIN " + INSERT_INDEX + "END",
+    "CREATE TRIGGER IF NOT EXISTS item_fts_delete AFTER DELETE ON item BEGIN " + DELETE_INDEX + "END",
+    # 只有内容改变时才更新索引，切换完成状态不会触发
+    "CREATE TRIGGER IF NOT EXISTS item_fts_update AFTER UPDATE OF body, search_body ON item BEGIN " +
+    DELETE_INDEX + INSERT_INDEX + "END",
+]
+SEARCH_TRIGGERS = ['item_fts_insert', 'item_fts_delete', 'item_fts_update']
+
+item_fts = db.table('item_fts', db.column('rowid'), db.column('rank'))
+item_cjk = db.table('item_cjk', db.column('rowid'), db.column('rank'))
+
+
+def search_supported(connection):
+    """数据库是否是支持FTS5和trigram分词器的SQLite。"""
+    if connection.dialect.name != 'sqlite':
+        return False
+    version = tuple(int(part) for part in connection.execute('SELECT sqlite_version()').scalar().split('.'))
+    options = {row[0] for row in connection.execute('PRAGMA compile_options')}
+    return version >= (3, 34, 0) and 'ENABLE_FTS5' in options
+
+
+@event.listens_for(Item.__table__, 'after_create')
+def create_search_index(target, connection, **kw):
+    if search_supported(connection):
+        for statement in SEARCH_INDEX_DDL:
+            connection.execute(statement)
+
+
+@event.listens_for(Item.__table__, 'before_drop')
+def drop_search_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute('DROP TABLE IF EXISTS item_fts')
+        connection.execute('DROP TABLE IF EXISTS item_cjk')
+
+
+def rebuild_search_index(batch_size=1000):
+    """为已有的数据库创建索引和触发器，补上search_body，并从item表重新生成全部索引。数据库不支持时返回False。"""
+    with db.engine.begin() as connection:
+        if not search_supported(connection):
+            return False
+        # 旧版本的触发器不同步item_cjk，删除后重新创建
+        for trigger in SEARCH_TRIGGERS:
+            connection.execute('DROP TRIGGER IF EXISTS %s' % trigger)
+        items = Item.__table__
+        while True:
+            rows = connection.execute(db.select([items.c.id, items.c.body]).where(
+                items.c.search_body.is_(None)).where(items.c.body.isnot(None)).limit(batch_size)).fetchall()
+            if not rows:
+                break
+            connection.execute(items.update().where(items.c.id == db.bindparam('item_id')).values(
+                search_body=db.bindparam('segmented')),
+                [dict(item_id=row.id, segmented=segment(row.body)) for row in rows])
+        create_search_index(items, connection)
+        connection.execute("INSERT INTO item_fts(item_fts) VALUES ('rebuild')")
+        connection.execute("INSERT INTO item_cjk(item_cjk) VALUES ('rebuild')")
+    return True
+
+
+def search_index_exists():
+    # 只缓存存在的结果，运行rebuild-search之后不用重启也能用上索引
+    if not current_app.extensions.get('todoism_search_index'):
+        if db.engine.dialect.name != 'sqlite':
+            return False
+        exists = db.session.execute("SELECT count(*) FROM sqlite_master "
+                                    "WHERE type = 'table' AND name IN ('item_fts', 'item_cjk')").scalar() == 2
+        current_app.extensions['todoism_search_index'] = exists
+    return current_app.extensions['todoism_search_index']
+
+
+def escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def fts_phrase(text, prefix=False):
+    return '"%s"%s' % (text.replace('"', '""'), '*' if prefix else '')
+
+
+def search_items(user_id, q):
+    """返回用户事项里包含q中所有词(用空白分隔)的查询，使用全文索引时按相关度排序，否则按id倒序。"""
+    terms = q.split()
+    query = Item.query.filter(Item.author_id == user_id)
+    segmented = [segment(term, query=True) for term in terms]
+    if all(any(c.isalnum() for c in term) for term in segmented) and search_index_exists():
+        if all(len(term) >= 3 for term in terms):
+            index, match = item_fts, ' '.join(fts_phrase(term) for term in terms)  # 每个词都作为短语匹配
+        else:
+            # 切分后的词作为短语，最后一个词按前缀匹配，一个字的搜索词也能匹配二元组
+            index, match = item_cjk, ' '.join(fts_phrase(term, prefix=True) for term in segmented)
+        return query.join(index, index.c.rowid == Item.id).filter(
+            db.literal_column(index.name).op('MATCH')(match)).order_by(index.c.rank, Item.id)
+    for term in terms:
+        query = query.filter(Item.body.like('%' + escape_like(term) + '%', escape='\\'))
+    return query.order_by(Item.id.desc())
@@ -0,0 +1,26 @@
+"""搜索用的中日韩文字切分。
+
+unicode61分词器把连续的中日韩字符当作一个词，这里把它们切成相邻两个字组成的词(二元组)，
+事项内容再加上每段的最后一个字，这样一个字的搜索词用前缀查询、两个字以上用二元组短语查询都能匹配任意位置。
+"""
+import re
+
+CJK_RUN = re.compile('[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+')  # 假名、汉字、谚文
+
+
+def segment(text, query=False):
+    """切分事项内容，query为True时切分搜索词，不加最后一个字。其他文字保持原样。"""
+    def split(match):
+        run = match.group()
+        if len(run) == 1:
+            return ' %s ' % run
+        tokens = [run[i:i + 2] for i in range(len(run) - 1)]
+        if not query:
+            tokens.append(run[-1])
+        return ' %s ' % ' '.join(tokens)
+    return ' '.join(CJK_RUN.sub(split, text or '').split())
+
+
+def segment_default(context):
+    """search_body列的默认值，批量插入(bulk_insert_mappings)也会调用。"""
+    return segment(context.get_current_parameters().get('body'))
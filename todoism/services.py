@@ -0,0 +1,110 @@
+"""这个模块放置被网页视图、api和模版上下文共同使用的事项操作。"""
+
+from flask import current_app, g, has_app_context
+from sqlalchemy import event, func
+
+from todoism.events import record_event
+from todoism.extensions import db
+from todoism.models import User, Item
+
+SQLITE_MAX_INTEGER = 2 ** 63 - 1
+
+
+def valid_item_id(value):
+    """是否是SQLite整数范围内的非负整数。bool不算整数，超出范围的值绑定参数时会抛出OverflowError。"""
+    return type(value) is int and 0 <= value <= SQLITE_MAX_INTEGER
+
+
+def get_item_counts(user_id):
+    """返回用户所有、未完成和已完成事项的个数。
+
+    一次分组聚合查询得到全部计数，结果在当前请求内缓存，多个调用者共用同一个结果。
+    """
+    cache = g.setdefault('_item_counts', {})
+    if user_id not in cache:
+        rows = db.session.query(Item.done, func.count(Item.id)).filter(
+            Item.author_id == user_id).group_by(Item.done).all()
+        completed = sum(count for done, count in rows if done)
+        active = sum(count for done, count in rows if not done)
+        cache[user_id] = dict(all=active + completed, active=active, completed=completed)
+    return cache[user_id]
+
+
+def validate_item_body(body):
+    """检查事项内容，不是字符串或者空白时抛出ValueError。"""
+    if not isinstance(body, str) or body.strip() == '':
+        raise ValueError('事项是空的或者是无效值。')
+    return body
+
+
+def get_items_version(user_id):
+    """返回用户事项的版本号，只是一次主键查询。"""
+    return db.session.query(User.items_version).filter(User.id == user_id).scalar()
+
+
+def bump_items_version(user_ids, session=None):
+    """在当前事务里把这些用户的事项版本号加一。批量插入和删除不经过flush，需要手动调用。"""
+    if user_ids:
+        users = User.__table__
+        (session or db.session).execute(users.update().where(users.c.id.in_(user_ids)).values(
+            items_version=users.c.items_version + 1))
+
+
+def expire_item_counts():
+    """事项发生变化后丢弃当前请求缓存的计数。"""
+    if has_app_context():
+        g.pop('_item_counts', None)
+
+
+def clear_completed_items(user_id, batch_size=None):
+    """删除用户全部已完成的事项，返回删除的个数。
+
+    每批用一条DELETE删除最多batch_size个事项并单独提交，删除大量事项时不会长时间占用SQLite的写锁。
+    """
+    batch_size = batch_size or current_app.config['TODOISM_CLEAR_BATCH_SIZE']
+    items = Item.__table__
+    removed = 0
+    while True:
+        batch = db.select([items.c.id]).where(items.c.author_id == user_id).where(
+            items.c.done == True).limit(batch_size)  # noqa: E712
+        count = db.session.execute(items.delete().where(items.c.id.in_(batch))).rowcount
+        if count:
+            removed += count
+            bump_items_version([user_id])
+            record_event(user_id, 'clear', {})
+        db.session.commit()
+        if count < batch_size:
+            break
+    expire_item_counts()
+    return removed
+
+
+# 事项被新增、修改或删除时，和事项写入同一个事务增加作者的版本号。
+@event.listens_for(db.session, 'before_flush')
+def _bump_version_before_flush(session, flush_context, instances):
+    user_ids = set()
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Item) and (obj not in session.dirty or session.is_modified(obj)):
+            user_ids.add(obj.author.id if obj.author_id is None and obj.author is not None else obj.author_id)
+    user_ids.discard(None)
+    bump_items_version(user_ids, session)
+
+
+# 会话里有事项被新增、修改或删除时，缓存的计数就过期了。
+@event.listens_for(db.session, 'after_flush')
+def _expire_counts_after_flush(session, flush_context):
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Item):
+            expire_item_counts()
+            return
+
+
+# Query.delete() 这样的批量操作不会经过flush，需要单独处理。
+@event.listens_for(db.session, 'after_bulk_delete')
+def _expire_counts_after_bulk_delete(delete_context):
+    expire_item_counts()
+
+
+@event.listens_for(db.session, 'after_bulk_update')
+def _expire_counts_after_bulk_update(update_context):
+    expire_item_counts()
@@ -1,5 +1,6 @@
 import os
 
+from sqlalchemy.pool import QueuePool
 
 basedir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 
@@ -7,9 +8,60 @@ basedir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 class BaseConfig(object):
     TODOISM_LOCALES = ['zh_Hans_CN', 'en_US']  # 定义中文和英语语言支持
     TODOISM_ITEM_PER_PAGE = 20      # 每页显示数
+    TODOISM_ITEM_MAX_LIMIT = 100    # 游标分页时limit参数的上限
+    TODOISM_APP_WINDOW = 50         # 网页程序每次渲染的事项数
+    TODOISM_BATCH_MAX_OPERATIONS = 100  # 批量接口一次最多的操作数
+    TODOISM_IMPORT_CHUNK_SIZE = 500     # 导入事项时每个事务插入的行数
+    TODOISM_IMPORT_MAX_REJECTED = 100   # 导入接口最多返回的被拒绝行数
+    TODOISM_CLEAR_BATCH_SIZE = 500      # 清除已完成事项时每个事务删除的行数
+    TODOISM_EVENT_BROKER = os.getenv('TODOISM_EVENT_BROKER', 'todoism.events.InProcessBroker')  # 事件的发布/订阅后端
+    TODOISM_EVENT_LOG_SIZE = 200      # 每个用户保留的事件数
+    TODOISM_SSE_KEEPALIVE = 15        # 事件流发送保活注释的间隔秒数
+    TODOISM_SSE_STREAM_TIMEOUT = 300  # 同步运行时一个事件流保持的秒数
+    TODOISM_SSE_RETRY = 3000          # 客户端断线后重连的等待毫秒数
+    # 同步运行时也提供事件流。每个连接会一直占用一个工作线程，默认只在todoism.asgi下提供
+    TODOISM_SSE_SYNC = os.getenv('TODOISM_SSE_SYNC') == '1'
+    TODOISM_METRICS = os.getenv('TODOISM_METRICS') == '1'  # 开启性能统计和/debug/metrics
+    TODOISM_METRICS_TOKEN = os.getenv('TODOISM_METRICS_TOKEN')  # 设置后访问/debug/metrics需要?token=
+    TODOISM_METRICS_QUERY_THRESHOLD = 20    # 一个请求的查询数超过这个值时记为疑似N+1
+    TODOISM_METRICS_SLOW_QUERY = 0.1        # 慢查询的秒数
+    TODOISM_METRICS_SLOW_QUERY_SAMPLES = 20  # 保留的慢查询样本数
+    TODOISM_JSON_ENCODER = os.getenv('TODOISM_JSON_ENCODER', 'auto')  # api的JSON编码器：auto、orjson、ujson或json
+    TODOISM_COMPRESS_MIN_SIZE = 1024  # api响应超过这个字节数时才压缩
+    TODOISM_GZIP_LEVEL = 6
+    TODOISM_BROTLI_QUALITY = 4        # 动态响应使用较低的压缩等级，11太慢
+    TODOISM_ASGI_WORKERS = int(os.getenv('TODOISM_ASGI_WORKERS', 8))  # 异步运行时执行视图的线程数
 
     BABEL_DEFAULT_LOCALE = TODOISM_LOCALES[0]    # 默认设置是中文。
     SECRET_KEY = os.getenv('SECRET_KEY', 'sajfiojasiofhiahr')
+    # 密码哈希方法，格式是werkzeug的method参数，例如pbkdf2:sha256:150000，旧哈希在登录时自动升级
+    TODOISM_PASSWORD_METHOD = os.getenv('TODOISM_PASSWORD_METHOD', 'pbkdf2:sha256')
+    TODOISM_PASSWORD_WORKERS = int(os.getenv('TODOISM_PASSWORD_WORKERS', 2))  # 同时计算哈希的线程数
+    # 同时等待哈希的请求数，超过时返回503。要小于服务器的线程数，否则登录高峰会占满所有请求线程
+    TODOISM_PASSWORD_MAX_PENDING = int(os.getenv('TODOISM_PASSWORD_MAX_PENDING', 4))
+    TODOISM_PASSWORD_TIMEOUT = float(os.getenv('TODOISM_PASSWORD_TIMEOUT', 2))  # 等待哈希超过这个秒数时返回503
+    TODOISM_ACCESS_TOKEN_EXPIRATION = int(os.getenv('TODOISM_ACCESS_TOKEN_EXPIRATION', 3600))  # 访问令牌的有效秒数
+    TODOISM_REFRESH_TOKEN_EXPIRATION = int(os.getenv('TODOISM_REFRESH_TOKEN_EXPIRATION', 30 * 24 * 3600))  # 刷新令牌
+    TODOISM_ASSET_MANIFEST = False  # 使用flask build-assets生成的带哈希的静态文件
+    TODOISM_JINJA_BYTECODE_CACHE = False  # 把编译好的模版缓存到文件
+    TODOISM_JINJA_CACHE_DIR = os.getenv('TODOISM_JINJA_CACHE_DIR')  # 模版缓存目录，默认使用Jinja的临时目录
+    TODOISM_SESSION_USER_TTL = 300   # 会话里用户快照的有效秒数
+    TODOISM_TOKEN_CACHE_SIZE = 1024  # 令牌验证缓存最多保存的令牌数
+    TODOISM_TOKEN_CACHE_TTL = 300    # 令牌验证缓存的有效秒数
+    TODOISM_DEMO_REGISTER = os.getenv('TODOISM_DEMO_REGISTER', '1') == '1'  # 开启/register生成测试账号
+    TODOISM_RATELIMIT = os.getenv('TODOISM_RATELIMIT', '1') == '1'  # 开启写接口和认证接口的限速
+    # 每类接口的令牌桶：(每秒补充的令牌数, 桶容量)
+    TODOISM_RATE_LIMITS = {
+        'auth': (0.2, 10),   # 登录和签发令牌，每个IP每分钟12次，允许连续10次
+        'write': (20, 100),  # 创建、修改和删除事项，每个用户
+    }
+    TODOISM_RATELIMIT_BACKEND = os.getenv('TODOISM_RATELIMIT_BACKEND', 'todoism.ratelimit.InProcessBackend')
+    TODOISM_RATELIMIT_MAX_KEYS = 10000  # 进程内后端最多保存的令牌桶数
+    # 应用前面的可信反向代理层数，大于0时从X-Forwarded-For/X-Forwarded-Proto得到客户端IP和协议。
+    # 在nginx等代理后面运行时必须设置，否则所有没有登录的请求都按代理的IP限速，共用一个令牌桶
+    TODOISM_PROXY_FIX_X_FOR = int(os.getenv('TODOISM_PROXY_FIX_X_FOR', 0))
+    TODOISM_PROXY_FIX_X_PROTO = int(os.getenv('TODOISM_PROXY_FIX_X_PROTO', 0))
+    TODOISM_MAX_CONCURRENT_WRITES = int(os.getenv('TODOISM_MAX_CONCURRENT_WRITES', 8))  # 超过时返回503，0表示不限
 
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', 'sqlite:///' + os.path.join(basedir, 'data.db'))
     SQLALCHEMY_TRACK_MODIFICATIONS = False
@@ -20,11 +72,38 @@ class DevelopmentConfig(BaseConfig):
 
 
 class ProductionConfig(BaseConfig):
-    pass
+    TODOISM_DEMO_REGISTER = os.getenv('TODOISM_DEMO_REGISTER') == '1'
+    TODOISM_ASSET_MANIFEST = True
+    TODOISM_JINJA_BYTECODE_CACHE = True
+    # SQLite在多线程工作进程下的配置：WAL模式让读不阻塞写，busy_timeout让写锁冲突时等待而不是立即报错。
+    # 每个新连接建立时执行这些PRAGMA，所有值都可以用环境变量覆盖。
+    TODOISM_SQLITE_PRAGMAS = {
+        'journal_mode': os.getenv('TODOISM_SQLITE_JOURNAL_MODE', 'WAL'),
+        'synchronous': os.getenv('TODOISM_SQLITE_SYNCHRONOUS', 'NORMAL'),
+        'busy_timeout': int(os.getenv('TODOISM_SQLITE_BUSY_TIMEOUT', 5000)),  # 毫秒
+        'mmap_size': int(os.getenv('TODOISM_SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),  # 字节
+        'cache_size': int(os.getenv('TODOISM_SQLITE_CACHE_SIZE', -64000)),  # 负数表示KB
+    }
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.getenv('TODOISM_DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.getenv('TODOISM_DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.getenv('TODOISM_DB_POOL_TIMEOUT', 10)),
+    }
+    # 只在数据库是SQLite时合并到SQLALCHEMY_ENGINE_OPTIONS，和PRAGMA一样。
+    # 默认情况下SQLite文件数据库每次都新建连接(NullPool)，这里改为复用连接池里的连接。
+    TODOISM_SQLITE_ENGINE_OPTIONS = {
+        'poolclass': QueuePool,
+        'connect_args': {
+            'check_same_thread': False,  # 连接会被连接池交给不同的线程使用
+            'timeout': int(os.getenv('TODOISM_SQLITE_BUSY_TIMEOUT', 5000)) / 1000,
+        },
+    }
 
 
 class TestingConfig(BaseConfig):
     TESTING = True
+    TODOISM_PASSWORD_METHOD = 'pbkdf2:sha256:1000'  # 测试时不需要昂贵的哈希
+    TODOISM_RATELIMIT = False
     SQLALCHEMY_DATABASE_URI = 'sqlite:///'
     WTF_CSRF_ENABLED = False
 
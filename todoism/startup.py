@@ -0,0 +1,55 @@
+"""工作进程冷启动的测量。
+
+flask startup-profile 在新的Python进程里导入todoism并调用create_app，
+Python 3.7以上用-X importtime统计每个模块的导入耗时，再加上create_app各个阶段和第一个请求的耗时。
+新进程没有缓存的模块，测到的就是gunicorn等启动一个工作进程时的耗时。
+"""
+import json
+import subprocess
+import sys
+
+PROFILE_SCRIPT = '''
+import json, sys, time
+started = time.perf_counter()
+from todoism import create_app
+imported = time.perf_counter()
+app = create_app(sys.argv[1])
+created = time.perf_counter()
+client = app.test_client()
+client.get('/')
+first = time.perf_counter()
+client.get('/')
+second = time.perf_counter()
+print(json.dumps({
+    'import': imported - started,
+    'create_app': created - imported,
+    'phases': app.extensions['todoism_startup'],
+    'first_request': first - created,
+    'second_request': second - first,
+}))
+'''
+
+
+def parse_importtime(output):
+    """解析-X importtime的输出，返回[(模块, 自身秒数, 累计秒数)]。"""
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return modules
+
+
+def profile_startup(config_name):
+    """在新进程里测量冷启动，返回(测量结果, 模块导入耗时)。"""
+    command = [sys.executable]
+    importtime = sys.version_info >= (3, 7)
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-c', PROFILE_SCRIPT, config_name]
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1] if process.stderr.strip() else '启动失败')
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    return result, parse_importtime(process.stderr) if importtime else []
@@ -27,13 +27,48 @@ $(document).ready(function () {
         M.toast({html: message});
     });
 
+    // 每个页面生成一个id，服务器推送的事件里带有引起事件的页面id，页面忽略自己引起的事件。
+    var client_id = Math.random().toString(36).slice(2);
+
     $.ajaxSetup({
         beforeSend: function (xhr, settings) {
             if (!/^(GET|HEAD|OPTIONS|TRACE)$/i.test(settings.type) && !this.crossDomain) {
                 xhr.setRequestHeader('X-CSRFToken', csrf_token);
+                xhr.setRequestHeader('X-Client-Id', client_id);
             }
         }
     });
+
+    var event_source = null;
+    var reload_timer = null;
+
+    // 订阅事项变化的事件，其他页面或客户端修改了事项时重新加载事项页面。服务器不提供事件流时不实时更新
+    function listen_events() {
+        if (event_source !== null || !window.EventSource || !item_events_url) {
+            return;
+        }
+        event_source = new EventSource(item_events_url);
+        var reload = function (e) {
+            if (JSON.parse(e.data).origin === client_id) {
+                return;
+            }
+            // 短时间内的多个事件只刷新一次
+            clearTimeout(reload_timer);
+            reload_timer = setTimeout(function () {
+                $(window).trigger('hashchange');
+            }, 500);
+        };
+        $.each(['create', 'update', 'toggle', 'delete', 'clear', 'import', 'reset'], function (i, kind) {
+            event_source.addEventListener(kind, reload);
+        });
+    }
+
+    function close_events() {
+        if (event_source !== null) {
+            event_source.close();
+            event_source = null;
+        }
+    }
     // 当页面的后缀(hash）变化的时候，记录状态，使浏览的前进返回键发挥作用。
     $(window).bind('hashchange', function () {
         // 有的浏览器不#， 这里统一去掉#
@@ -53,6 +88,12 @@ $(document).ready(function () {
             success: function (data) {
                 $('#main').hide().html(data).fadeIn(800); //把返回的局部模版插入到main下。
                 activeM(); //激活新插入的页面的Materialize组件
+                load_more(); // 第一窗口的事项没有填满页面时继续加载
+                if ($('#item-input').length) {
+                    listen_events(); // 登录后的事项页面
+                } else {
+                    close_events();
+                }
             } // 错误回调已经统一的设置，不需要定义error回调。
         });
     });
@@ -75,7 +116,7 @@ $(document).ready(function () {
     $(document).on('click', '#toggle-password', toggle_password);
 
     function display_dashboard() {
-        var all_count = $('.item').length;
+        var all_count = parseInt($('#all-count').text());
         if (all_count === 0) {
             $('#dashboard').hide();
         } else {
@@ -107,23 +148,45 @@ $(document).ready(function () {
         $input.focus();
     }
 
-    function refresh_count() {
-        var $items = $('.item');
-
+    // 事项是分批加载的，页面上的事项不一定是全部事项，所以根据每次操作增减各个计数。
+    function update_count(all_delta, active_delta, completed_delta) {
+        var deltas = {'#all-count': all_delta, '#active-count': active_delta, '#completed-count': completed_delta};
+        $.each(deltas, function (selector, delta) {
+            $(selector).html(parseInt($(selector).text()) + delta);
+        });
+        $('#active-count-nav').html($('#active-count').text());
         display_dashboard();
-        var all_count = $items.length;
-        var active_count = $items.filter(function () {
-            return $(this).data('done') === false;
-        }).length;
-        var completed_count = $items.filter(function () {
-            return $(this).data('done') === true;
-        }).length;
-        $('#all-count').html(all_count);
-        $('#active-count').html(active_count);
-        $('#active-count-nav').html(active_count);
-        $('#completed-count').html(completed_count);
     }
 
+    var loading_items = false;
+
+    // 滚动到接近页面底部时加载下一窗口的事项
+    function load_more() {
+        var $items = $('.items');
+        var next_url = $items.data('next');
+        if (!next_url || loading_items) {
+            return;
+        }
+        if ($(window).scrollTop() + $(window).height() < $(document).height() - 200) {
+            return;
+        }
+        loading_items = true;
+        $.ajax({
+            type: 'GET',
+            url: next_url,
+            success: function (data) {
+                $items.append(data.html).data('next', data.next || '');
+                loading_items = false;
+                load_more();
+            },
+            error: function () {
+                loading_items = false;
+            }
+        });
+    }
+
+    $(window).on('scroll', load_more);
+
     function new_item(e) {
         var $input = $('#item-input');
         var value = $input.val().trim();
@@ -138,9 +201,12 @@ $(document).ready(function () {
             contentType: 'application/json;charset=UTF-8',
             success: function (data) {
                 M.toast({html: data.message, classes: 'rounded'});
-                $('.items').append(data.html); // 把返回条目的html代码插入页面。
+                // 还有没加载的窗口时，新事项id最大，会在最后一个窗口里加载，这里不插入，避免显示两次
+                if (!$('.items').data('next')) {
+                    $('.items').append(data.html); // 把返回条目的html代码插入页面。
+                }
                 activeM();  // 激活新插入的materialize组件
-                refresh_count(); // 更新页面上的各个计数
+                update_count(1, 1, 0); // 更新页面上的各个计数
             }
         });
     }
@@ -198,7 +264,7 @@ $(document).ready(function () {
                     $this.find('i').text('check_box_outline_blank');
                     $item.data('done', false);
                     M.toast({html: data.message});
-                    refresh_count();
+                    update_count(0, 1, -1);
                 }
             })
         } else {
@@ -211,7 +277,7 @@ $(document).ready(function () {
                     $this.find('i').text('check_box');
                     $item.data('done', true);
                     M.toast({html: data.message});
-                    refresh_count();
+                    update_count(0, -1, 1);
                 }
             })
 
@@ -273,7 +339,11 @@ $(document).ready(function () {
             success: function (data) {
                 $item.remove();
                 activeM();
-                refresh_count();
+                if ($item.data('done')) {
+                    update_count(-1, 0, -1);
+                } else {
+                    update_count(-1, -1, 0);
+                }
                 M.toast({html: data.message});
             }
         });
@@ -346,31 +416,40 @@ $(document).ready(function () {
     });
 
 
-    $(document).on('click', '#active-item', function () {
-        var $input = $('#item-input');
-        var $items = $('.item');
-
-        $input.focus();
-        $items.show();
-        $items.filter(function () {
-            return $(this).data('done');
-        }).hide();
-    });
-
-    $(document).on('click', '#completed-item', function () {
-        var $input = $('#item-input');
-        var $items = $('.item');
-
-        $input.focus();
-        $items.show();
-        $items.filter(function () {
-            return !$(this).data('done');
-        }).hide();
+    // 切换标签页时从服务器加载这个标签页的第一窗口事项
+    $(document).on('click', '#all-item, #active-item, #completed-item', function () {
+        $('#item-input').focus();
+        $.ajax({
+            type: 'GET',
+            url: $(this).data('href'),
+            success: function (data) {
+                $('.items').html(data.html).data('next', data.next || '');
+                load_more();
+            }
+        });
     });
 
-    $(document).on('click', '#all-item', function () {
-        $('#item-input').focus();
-        $('.item').show();
+    // 输入搜索词后稍等再搜索，清空搜索框时重新加载当前标签页
+    var search_timer = null;
+    $(document).on('input', '#search-input', function () {
+        var $input = $(this);
+        clearTimeout(search_timer);
+        search_timer = setTimeout(function () {
+            var q = $input.val().trim();
+            if (!q) {
+                $('ul.tabs a.active').click();
+                return;
+            }
+            $.ajax({
+                type: 'GET',
+                url: $input.data('href'),
+                data: {q: q},
+                success: function (data) {
+                    $('.items').html(data.html).data('next', data.next || '');
+                    load_more();
+                }
+            });
+        }, 300);
     });
 
     $(document).on('click', '#clear-btn', function () {
@@ -382,11 +461,12 @@ $(document).ready(function () {
             type: 'DELETE',
             url: clear_item_url,
             success: function (data) {
+                var completed_count = parseInt($('#completed-count').text());
                 $items.filter(function () {
                     return $(this).data('done');
                 }).remove();
                 M.toast({html: data.message, classes: 'rounded'});
-                refresh_count();
+                update_count(-completed_count, 0, -completed_count);
             }
         });
     });
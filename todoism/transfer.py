@@ -0,0 +1,106 @@
+"""这个模块实现事项的批量导出和导入，导出格式是每行一个JSON对象的NDJSON，导入还支持CSV。"""
+
+import csv
+import json
+import zlib
+
+from todoism.events import record_event
+from todoism.extensions import db
+from todoism.models import User, Item
+from todoism.services import validate_item_body, expire_item_counts, bump_items_version
+
+
+def user_items_query(user_id):
+    # 只查询需要的列，不创建ORM对象。
+    return db.session.query(Item.id, Item.body, Item.done).filter(
+        Item.author_id == user_id).order_by(Item.id)
+
+
+def all_items_query():
+    return db.session.query(Item.id, Item.body, Item.done, User.username).join(
+        Item.author).order_by(Item.author_id, Item.id)
+
+
+def generate_ndjson(query, batch_size=1000):
+    """逐行生成NDJSON。
+
+    yield_per让数据库游标每次只取batch_size行，内存占用和事项总数无关。
+    """
+    for row in query.yield_per(batch_size):
+        yield json.dumps(row._asdict(), ensure_ascii=False) + '\n'
+
+
+def gzip_chunks(chunks, level=6):
+    """把生成的文本块压缩成gzip格式的字节块。"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 表示gzip文件头
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def parse_records(stream, format='ndjson'):
+    """逐行解析文本流，生成(行号, 记录)，无法解析的行记录为None。"""
+    if format == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_no, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_no, json.loads(line)
+        except ValueError:
+            yield line_no, None
+
+
+def parse_done(value):
+    if value is None or value == '':
+        return False
+    if isinstance(value, bool):
+        return value
+    if str(value).strip().lower() in ('1', 'true', 'yes', 'y'):
+        return True
+    if str(value).strip().lower() in ('0', 'false', 'no', 'n'):
+        return False
+    raise ValueError('无效的完成状态。')
+
+
+def import_items(user_id, records, chunk_size=500, progress=None):
+    """把记录批量插入为user_id的事项，返回(导入数, [(行号, 原因)])。
+
+    每chunk_size行用一次批量插入并提交一次事务，导入大量数据时不会长时间占用SQLite的写锁。
+    progress是可选的回调函数，每提交一批调用一次，参数是已经导入的事项数。
+    """
+    imported = 0
+    rejected = []
+    chunk = []
+
+    def flush():
+        db.session.bulk_insert_mappings(Item, chunk)
+        bump_items_version([user_id])
+        record_event(user_id, 'import', {'count': len(chunk)})
+        db.session.commit()
+        del chunk[:]
+        if progress is not None:
+            progress(imported)
+
+    for line_no, record in records:
+        if not isinstance(record, dict):
+            rejected.append((line_no, '无效的记录。'))
+            continue
+        try:
+            chunk.append(dict(body=validate_item_body(record.get('body')),
+                              done=parse_done(record.get('done')), author_id=user_id))
+        except ValueError as e:
+            rejected.append((line_no, e.args[0]))
+            continue
+        imported += 1
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+    expire_item_counts()  # 批量插入不经过会话的flush事件
+    return imported, rejected